@@ -12,16 +12,24 @@ import struct
 import numpy as np
 import scipy as sp
 import scipy.io
+import os
 import netCDF4 as nc
 try:
     import matplotlib.pyplot as plt
     import matplotlib.animation as animation
 except:
     pass
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import time
 import datetime
-import os
-import sys
+import re
+import queue
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 eform = '>i16f7504f100f28f28f'
@@ -38,6 +46,42 @@ xtest2form = '>i16f1023f2065i128f28f28f'
 
 sform = '>i16f10000f'
 
+# Position of the named values in the housekeeping field of the formats
+hkfields = {'cold_load': 0, 'hot_load': 1, 'air_temp': 2, 'rel_humid': 3,
+            'chop_pos': 4, 'int_time': 5, 'temp_b2': 6, 'temp_b3': 7,
+            'temp_77k': 8, 'temp_15k': 9, 'temp_4k': 10, 'lo_b2': 11,
+            'lo_b3': 12, 'lo_ref': 13, 'f_req': 14, 'if_req': 15}
+
+# Chopper order of the modes of measurements, as given by get_order()
+phase_orders = {'antenna': ['C', 'A', 'H', 'A'],
+                'reference': ['C', 'R', 'H', 'R'],
+                'mixed': ['C', 'A', 'R', 'H']}
+
+# Storage profiles of raw_nc variables.  Variables are chunked along the
+# records in chunks of about chunk_bytes, and take the other keys as
+# netCDF4 createVariable keywords.  least_significant_digit is only used
+# for the "record" counts and makes the compression lossy.
+storage_profiles = {'contiguous': {},
+                    'default': {'chunk_bytes': 1 << 18, 'zlib': True,
+                                'complevel': 1, 'shuffle': True},
+                    'archive': {'chunk_bytes': 4 << 20, 'zlib': True,
+                                'complevel': 6, 'shuffle': True}}
+
+
+def phase_order(order):
+    """ Returns the chopper order as a list of letters
+
+        Input:
+            order (str or list):
+                mode of measurements or a list like measurements.get_order()
+    """
+    if isinstance(order, str):
+        if order not in phase_orders:
+            raise RuntimeError(("'antenna', 'reference', and 'mixed' are the "
+                                "optional modes.  Not " + str(order)))
+        return phase_orders[order]
+    return list(order)
+
 
 def formatting(type='e'):
     if type == 'e':
@@ -56,44 +100,171 @@ def formatting(type='e'):
         return None
 
 
+def format_dtype(format):
+    """ Returns the numpy structured dtype of a record format
+
+        The first variable is named "time" and the following are
+        named "field0", "field1", ... so that "fieldN" is the same
+        field as _files._format[N].
+
+        Input:
+            format (str):
+                struct-style record format, e.g. eform
+    """
+    order = format[0] if format[0] in '<>=!@' else '>'
+    if order in '!@':
+        order = '>' if order == '!' else '='
+
+    fields = re.findall(r'(\d*)([a-zA-Z])', format)
+    assert fields, "Cannot understand format: " + format
+
+    dtype = []
+    for i, (count, type) in enumerate(fields):
+        name = 'time' if i == 0 else 'field' + str(i-1)
+        count = int(count) if count else 1
+        if count == 1:
+            dtype.append((name, order + type))
+        else:
+            dtype.append((name, order + type, (count, )))
+    return np.dtype(dtype)
+
+
 class _files:
     def load(self, filename):
         self._filename = filename
-        raw = []
-        time = []
 
         s = os.stat(filename).st_size
-        nbits = 0
-        # Read everything
-        with open(filename, 'rb') as file:
-            while True:
-                try:
-                    time.append(np.frombuffer(file.read(4), '>i')[0])
-                    raw.append(np.frombuffer(file.read(self._size-4), '>f'))
-                    nbits += self._size
-                    if nbits == s:
-                        break
-                except:
-                    raise RuntimeError("Error in reading file. Wrong bitcount")
-        assert len(raw) > 3, "No full data in: " + filename
-
-        self._raw = raw
-        self._rawtime = time
-
-    def load_list(self, filenames):
-        assert isinstance(filenames, (list, np.array)), "Not list of files"
-        self._filename = filenames[0]
+        if s % self._size:
+            raise RuntimeError("Error in reading file. Wrong bitcount")
+        assert s // self._size > 3, "No full data in: " + filename
+
+        # Map everything, nothing is read before it is used
+        self._map(filename, 0, s // self._size)
+
+    def load_time(self, filename, t0, t1, cycle=4):
+        """ Loads the records with t0 <= time < t1
+
+        The records are found with the index of the file, see raw_index,
+        so only the records of the time range are read.
+
+        Parameters:
+            filename (str):
+                Name of the file
+            t0 (num):
+                First time to load
+            t1 (num):
+                Time to load up to
+            cycle (int):
+                Records per chopper cycle, the first record is moved back
+                to the start of its cycle
+        """
+        self._filename = filename
 
-        self._raw = []
-        self._rawtime = []
+        r0, r1 = raw_index(filename, self._struct.format).records(t0, t1)
+        r0 -= r0 % cycle
+        assert r1 - r0 > 3, "No full data in time range of: " + filename
+
+        self._map(filename, r0, r1 - r0)
+
+    def _map(self, filename, r0, n):
+        """ Maps n records of filename from record r0 """
+        self._records = np.memmap(filename, dtype=self._dtype, mode='r',
+                                  offset=r0*self._size, shape=(n, ))
+        self._rawarray = self._records.view('>f4').reshape(
+                len(self._records), self._size // 4)[:, 1:]
+        self._rawtimearray = self._records['time']
+
+        self._rawlist = None
+        self._rawtimelist = None
+
+    @property
+    def _raw(self):
+        """ List of records without time, kept for old code """
+        if getattr(self, '_rawlist', None) is None:
+            self._rawlist = list(self._rawarray)
+        return self._rawlist
+
+    @_raw.setter
+    def _raw(self, raw):
+        self._rawlist = raw
+
+    @property
+    def _rawtime(self):
+        """ List of record times, kept for old code """
+        if getattr(self, '_rawtimelist', None) is None:
+            self._rawtimelist = list(self._rawtimearray)
+        return self._rawtimelist
+
+    @_rawtime.setter
+    def _rawtime(self, rawtime):
+        self._rawtimelist = rawtime
+
+    def _raw_array(self):
+        """ Returns the records as a (records, values) array """
+        if getattr(self, '_rawlist', None) is None:
+            return self._rawarray
+        return np.array(self._rawlist)
+
+    def _rawtime_array(self):
+        """ Returns the record times as an array """
+        if getattr(self, '_rawtimelist', None) is None:
+            return self._rawtimearray
+        return np.array(self._rawtimelist)
+
+    def _field_array(self, field):
+        """ Returns a (records, values) view of a field of the format
+
+            Input:
+                field (int):
+                    index of the field in self._format
+        """
+        s = self._format[:field].sum()
+        return self._rawarray[:, s:s+self._format[field]]
+
+    def load_list(self, filenames, workers=4):
+        """ Loads several files into one contiguous array
+
+        Parameters:
+            filenames (list):
+                Names of the files in order
+            workers (int):
+                Number of files read at the same time
+        """
+        assert isinstance(filenames, (list, np.ndarray)), "Not list of files"
+        self._filename = filenames[0]
 
-        tmp = _files()
-        tmp._size = self._size
+        # Size everything first so that the files can be read into place
+        counts = []
         for f in filenames:
-            print('loading', f)
-            tmp.load(f)
-            self._raw.extend(tmp._raw)
-            self._rawtime.extend(tmp._rawtime)
+            s = os.stat(f).st_size
+            if s % self._size:
+                raise RuntimeError("Error in reading file. Wrong bitcount")
+            assert s // self._size > 3, "No full data in: " + f
+            counts.append(s // self._size)
+        offsets = np.cumsum([0] + counts) * self._size
+
+        self._records = np.empty(sum(counts), dtype=self._dtype)
+        buffer = memoryview(self._records.view(np.uint8))
+
+        def read(i):
+            with open(filenames[i], 'rb') as file:
+                n = file.readinto(buffer[offsets[i]:offsets[i+1]])
+            if n != offsets[i+1] - offsets[i]:
+                raise RuntimeError("Error in reading file. Wrong bitcount")
+
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(read, range(len(filenames))))
+        dt = max(time.time() - t0, 1e-9)
+        print('loaded {} files, {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(
+                len(filenames), offsets[-1] / 1e6, dt, offsets[-1] / 1e6 / dt))
+
+        self._rawarray = self._records.view('>f4').reshape(
+                len(self._records), self._size // 4)[:, 1:]
+        self._rawtimearray = self._records['time']
+
+        self._rawlist = None
+        self._rawtimelist = None
 
     def append(self, data):
         for d in data._data:
@@ -117,6 +288,7 @@ class _files:
                 t = ''
         del f[0]
         self._format = np.array(f)
+        self._dtype = format_dtype(format)
 
 
 class calibration(_files):
@@ -152,99 +324,195 @@ class calibration(_files):
             with_hkp (boulean):
                 **INFO**
         """
-        # Delete mismatching data
-        while len(self._raw) % 2:
-            del self._raw[-1]
+        time, data, signal, noise = self.calibrate_array(
+                self._raw_array(), self._rawtime_array(),
+                sweep_count=sweep_count, with_hkp=with_hkp)
+
+        # Storage variables, rows are views of the calibrated arrays
+        self._data = list(data)
+        self._time = list(time)
+        self._noise = list(noise)
+        self._signal = list(signal)
+
+    def calibrate_array(self, raw, rawtime, sweep_count=None, with_hkp=False,
+                        block=1024):
+        """ Calibrates all the cycles of a (records, values) array at once
+
+        The records must alternate load and measurement, where the loads
+        alternate between cold and hot starting with self._hot.  Every
+        measurement is calibrated against the load before it and the
+        other load before that (the one after it for the first cycle of
+        a sweep).  self._hot is left as if all records were walked.
 
-        if sweep_count:
-            sweep = True
-        else:
-            sweep = False
+        Parameters:
+            raw (array):
+                (records, values) array of records without the time
+            rawtime (array):
+                times of the records
+            sweep_count (None type):
+                **INFO**
+            with_hkp (boulean):
+                **INFO**
+            block (int):
+                number of cycles computed together
+
+        Returns:
+            time (array):
+                times of the calibrated records
+            data (array):
+                calibrated records in the same layout as the raw records
+            signal (array):
+                calibrated spectra, a view of data
+            noise (array):
+                noise temperature spectra
+        """
+        cold_ind, hot_ind, meas_ind = \
+            self._calibration_indices(len(raw), sweep_count)
 
         # Storage variables
-        self._data = []
-        self._time = []
-        self._noise = []
-        self._signal = []
+        m = len(meas_ind)
+        time = np.asarray(rawtime)[meas_ind]
+        data = np.empty((m, raw.shape[1]), dtype=np.float32)
+        noise = np.empty((m, self._format[self._data_field]),
+                         dtype=np.float32)
 
-        # Calibration loop
-        i = 0  # raw-counter
-        count = 1  # calibrated counter
+        for i0 in range(0, m, block):
+            i1 = min(i0 + block, m)
+            self._calibrate_records(raw, cold_ind[i0:i1], hot_ind[i0:i1],
+                                    meas_ind[i0:i1], with_hkp,
+                                    data[i0:i1], noise[i0:i1])
+
+        return time, data, self._signal_view(data), noise
+
+    def iter_calibrated(self, filename, chunk_records=4096, sweep_count=None,
+                        with_hkp=False):
+        """ Calibrates a raw file chunk by chunk
+
+        Only the records of the current chunk, and the loads on either
+        side of it, are read from the file so the memory use does not
+        depend on the size of the file.  The cycles are the same as for
+        calibrate, see calibrate_array.
+
+        Parameters:
+            filename (str):
+                Name of the raw file
+            chunk_records (int):
+                Number of raw records per chunk
+            sweep_count (None type):
+                **INFO**
+            with_hkp (boulean):
+                **INFO**
+
+        Returns:
+            Generator of (time, data, signal, noise) as for calibrate_array
+        """
+        self._filename = filename
+
+        s = os.stat(filename).st_size
+        if s % self._size:
+            raise RuntimeError("Error in reading file. Wrong bitcount")
+        assert s // self._size > 3, "No full data in: " + filename
+
+        inds = self._calibration_indices(s // self._size, sweep_count)
+        step = max(chunk_records // 2, 1)
+
+        def chunks():
+            with open(filename, 'rb') as file:
+                for i0 in range(0, len(inds[2]), step):
+                    cold_ind, hot_ind, meas_ind = \
+                        [x[i0:i0+step] for x in inds]
+                    r0 = min(cold_ind.min(), hot_ind.min())
+                    r1 = max(cold_ind.max(), hot_ind.max(), meas_ind.max())+1
+
+                    file.seek(r0 * self._size)
+                    records = np.fromfile(file, dtype=self._dtype,
+                                          count=r1-r0)
+                    raw = records.view('>f4').reshape(
+                            r1-r0, self._size // 4)[:, 1:]
+
+                    m = len(meas_ind)
+                    data = np.empty((m, raw.shape[1]), dtype=np.float32)
+                    noise = np.empty((m, self._format[self._data_field]),
+                                     dtype=np.float32)
+                    self._calibrate_records(raw, cold_ind-r0, hot_ind-r0,
+                                            meas_ind-r0, with_hkp,
+                                            data, noise)
+                    yield records['time'][meas_ind-r0], data, \
+                        self._signal_view(data), noise
+        return chunks()
+
+    def _calibration_indices(self, nrecords, sweep_count=None):
+        """ Returns the cold, hot and measurement record of every cycle
+
+        self._hot is left as if all records were walked
+        """
+        # A trailing load without measurement is not used
+        ncycles = nrecords // 2
+        assert ncycles > 1, "Need at least two calibration cycles"
+        hot0 = self._hot
+        self._hot = bool(hot0 ^ (ncycles % 2))
+
+        # Index of the load in front of the measurement and the other load
+        k = np.arange(ncycles)
+        if sweep_count:
+            first = (k % sweep_count) == 0
+            keep = (k % sweep_count) != (sweep_count - 1)
+        else:
+            first = k == 0
+            keep = np.ones(ncycles, dtype=bool)
+        own = 2 * k
+        other = np.where(first, own + 2, own - 2)
+        other[other >= 2 * ncycles] -= 4
+        hot = (k % 2 == 1) != hot0
+        return np.where(hot, other, own)[keep], \
+            np.where(hot, own, other)[keep], (own + 1)[keep]
+
+    def _calibrate_records(self, raw, cold_ind, hot_ind, meas_ind, with_hkp,
+                           data, noise):
+        """ Calibrates the given cycles of raw into data and noise """
         d = self._format[self._data_field]  # Number of data
         n = self._format[self._noise_field]  # Number of noise
         s = self._format[:self._data_field].sum()  # Start of data
         e = s + d  # End of data
-        while i < len(self._raw):
-            # Set the current hot or cold load measurement power
-            if self._hot:
-                h = self._raw[i][s:e]
-                if not with_hkp:
-                    th = self._th
-                elif self._raw[i][1] > 0:
-                    th = self._raw[i][0]
-                else:
-                    th = self._th
-            else:
-                c = self._raw[i][s:e]
-                if not with_hkp:
-                    tc = self._tc
-                elif self._raw[i][0] > 0:
-                    tc = self._raw[i][0]
-                else:
-                    tc = self._tc
-
-            # Set the current measurement power
-            i += 1
-            self._hot = not self._hot
-            data = np.array(self._raw[i][:s])
-            data_end = self._raw[i][(e+n):]
-            m = self._raw[i][s:e]
-            i += 1
-
-            # Read ahead to use the first data record
-            if count == 1:
-                if self._hot:
-                    h = self._raw[i][s:e]
-
-                    if not with_hkp:
-                        th = self._th
-                    elif self._raw[i][1] > 0:
-                        th = self._raw[i][0]
-                    else:
-                        th = self._th
-                else:
-                    c = self._raw[i][s:e]
-                    if not with_hkp:
-                        tc = self._tc
-                    elif self._raw[i][0] > 0:
-                        tc = self._raw[i][0]
-                    else:
-                        tc = self._tc
-
-            signal = tc + (m-c)*(th-tc)/(h-c)
-            noise_array = ((th*c-tc*h)/(h-c))
-            noise = noise_array.reshape(n, d//n).mean(axis=1)
-            data[0] = tc
-            data[1] = th
-
-            # Store
-            if sweep:
-                if not count % sweep_count:
-                    count = 1
-                    continue
-            self._noise.append(noise_array)
-            self._signal.append(signal)
-            self._data.append(np.append(np.append(np.append(data, signal),
-                                                  noise), data_end))
-            self._time.append(self._rawtime[i-1])
-
-            count += 1
 
-    def save(self, filename=None):
+        c = raw[cold_ind, s:e]
+        h = raw[hot_ind, s:e]
+        m = raw[meas_ind, s:e]
+
+        tc = self._load_temperature(raw, cold_ind, 0, self._tc, with_hkp)
+        th = self._load_temperature(raw, hot_ind, 1, self._th, with_hkp)
+
+        data[:, s:e] = tc + (m-c)*(th-tc)/(h-c)
+        noise[:] = (th*c-tc*h)/(h-c)
+
+        data[:, :s] = raw[meas_ind, :s]
+        data[:, 0] = tc[:, 0]
+        data[:, 1] = th[:, 0]
+        data[:, e:e+n] = noise.reshape(len(noise), n, d//n).mean(axis=2)
+        data[:, e+n:] = raw[meas_ind, e+n:]
+
+    def _signal_view(self, data):
+        """ The calibrated spectra of calibrated records """
+        s = self._format[:self._data_field].sum()  # Start of data
+        return data[:, s:s+self._format[self._data_field]]
+
+    def _load_temperature(self, raw, inds, flag, default, with_hkp):
+        """ Load temperatures as a column, housekeeping value if flagged """
+        if not with_hkp:
+            return np.full((len(inds), 1), default, dtype=np.float32)
+        hk = raw[inds, :2]
+        return np.where(hk[:, flag] > 0, hk[:, 0],
+                        np.float32(default)).reshape(len(inds), 1)
+
+    def save(self, filename=None, blocks=None):
         """
         Parameters:
             filename (str or None type):
                 Name of the file
+            blocks (iterable or None type):
+                (time, data, ...) blocks to write one after the other,
+                e.g., from iter_calibrated.  Saves the calibrated data
+                if None
         """
         if not filename:
             filename = self._filename
@@ -255,13 +523,17 @@ class calibration(_files):
         elif '.clb' not in filename[-4:]:
             filename += '.clb'
 
-        file = open(filename, 'wb')
-        for i in range(len(self._time)):
-            t = self._time[i]
-            file.write(np.array([t], dtype='i').byteswap().tobytes())
-            d = self._data[i].byteswap()
-            file.write(d.tobytes())
-        file.close()
+        if blocks is None:
+            blocks = [(self._time, self._data)]
+
+        with open(filename, 'wb') as file:
+            for block in blocks:
+                time, data = block[0], block[1]
+                out = np.empty(len(time), dtype=self._dtype)
+                out['time'] = time
+                out.view('>f4').reshape(len(time), self._size // 4)[:, 1:] \
+                    = data
+                out.tofile(file)
 
 
 class averaging(_files):
@@ -294,140 +566,104 @@ class averaging(_files):
             running_average (boolean):
                 **INFO**
         """
-        # Storage variables
-        self._data = []
-        self._time = []
-
-        # Calibration loop
-        d = self._format[self._data_field]  # Number of data
-        s = self._format[:self._data_field].sum()  # Start of data
-        e = s + d  # End of data
-
-        # Counter
-        j = 0
-        for i in range(len(self._rawtime)):
-            t = self._rawtime[i]
-            d = self._raw[i][s:e]
-
-            if running_average or j == 0:
-                self._time.append([t])
-                self._data.append(d)
-
-            if j >= number_of_spectra and running_average:
-                self._time[i - number_of_spectra].append(t)
-                if j == 0:
-                    continue
-            elif j == number_of_spectra:
-                self._time[-1].append(t)
-                j = 0
-                continue
-
-            # Average results up
-            if running_average:
-                for k in range(i-1, i - number_of_spectra, -1):
-                    if k < 0:
-                        break
-                    self._data[k] = self._data[k] + d
-            else:
-                self._data[-1] = self._data[-1] + d
-
-            j += 1
-
-        # Remove running average that are not averaged
-        while len(self._time[-1]) < 2:
-            del self._data[-1]
-            del self._time[-1]
-
-        for i in range(len(self._data)):
-            first = True
-            while self._data[i].shape[0] % number_of_xbin:
-                if first:
-                    np.delete(self._data[i], 0)
-                else:
-                    np.delete(self._data[i], -1)
-                first = not first
-            s = (len(self._data[i]) // number_of_xbin, number_of_xbin)
-            self._data[i] = self._data[i].reshape(s).mean(axis=1)
+        k = number_of_spectra
+        t = self._rawtime_array()
+        n = len(t)
+        assert n > k, "Not enough spectra to average"
+
+        # Sums are float64 over blocks of binned spectra, so no more than
+        # a block is ever held in float64
+        x = self._xbin_view(self._field_array(self._data_field),
+                            number_of_xbin)
+        block = 64
+
+        if running_average:
+            # Window i averages spectra i to i+k-1, and ends at time i+k.
+            # Its sum is the sum of window i-1 with spectrum i+k-1 added
+            # and spectrum i-1 removed
+            data = np.empty((n-k, x.shape[1]), dtype=np.float32)
+            s = 0
+            for i in range(0, k, block):
+                s = s + x[i:min(i+block, k)].sum(axis=(0, 2), dtype=np.float64)
+            data[0] = s / (k * number_of_xbin)
+            for i0 in range(1, n-k, block):
+                i1 = min(i0+block, n-k)
+                s = s + np.cumsum(x[i0+k-1:i1+k-1].sum(axis=2, dtype=np.float64) -
+                                  x[i0-1:i1-1].sum(axis=2, dtype=np.float64), axis=0)
+                data[i0:i1] = s / (k * number_of_xbin)
+                s = s[-1]
+            time = np.stack((t[:n-k], t[k:]), axis=1)
+        else:
+            # Block of k spectra, the next spectrum ends it and is not used
+            nb = n // (k+1)
+            x = x[:nb*(k+1)].reshape(nb, k+1, x.shape[1], number_of_xbin)
+            data = np.empty((nb, x.shape[2]), dtype=np.float32)
+            m = max(1, block // k)
+            for i in range(0, nb, m):
+                data[i:i+m] = x[i:i+m, :k].sum(axis=(1, 3), dtype=np.float64) / \
+                    (k * number_of_xbin)
+            time = np.stack((t[0:nb*(k+1):k+1], t[k:nb*(k+1):k+1]), axis=1)
 
-        # Actually average the data
-        for d in self._data:
-            d /= number_of_spectra
+        # Storage variables
+        self._data = list(data)
+        self._time = time.tolist()
 
-    def average_sweep(self, number_of_xbin=2):
+    def average_sweep(self, number_of_xbin=2, sweep_field='f_req'):
         """
         Parameters:
             number_of_xbin (int):
                 **INFO**
+            sweep_field (str):
+                housekeeping field that is stepped in the sweep, see
+                hkfields.  measurements.update_freq steps f_req.  The
+                old code read field 15, if_req, which is fixed in files
+                of measurements, so use 'if_req' only to split as it did
         """
+        t = self._rawtime_array()
+        d = self._field_array(self._data_field)
+        f = self._field_array(0)[:, hkfields[sweep_field]]
+
+        # Reject spectra out of the error range
+        bad = np.any(d < self._error_range[0], axis=1) | \
+            np.any(d > self._error_range[1], axis=1)
+        good = np.flatnonzero(~bad)
+        assert len(good), "No spectra within the error range"
+
+        # A step starts when the frequency changes between good spectra
+        start = np.concatenate(([0], np.flatnonzero(np.diff(f[good])) + 1))
+        end = np.append(start[1:], len(good))
+
+        # The last step is only full if it runs to the end of the file
+        if good[-1] != len(t) - 1 or end[-1] - start[-1] < 2:
+            start = start[:-1]
+            end = end[:-1]
+        assert len(start), "No full step in the sweep"
+
+        x = self._xbin_array(d[good[:end[-1]]], number_of_xbin)
+        count = end - start
+
         # Storage variables
-        self._data = []
-        self._time = []
-        self._f0 = []
+        self._data = list(np.float32(
+                np.add.reduceat(x, start, axis=0) / count[:, np.newaxis]))
+        self._time = np.stack((t[good[start]], t[good[end-1]]),
+                              axis=1).tolist()
+        self._f0 = f[good[start]].tolist()
 
-        # Calibration loop
-        d = self._format[self._data_field]  # Number of data
-        s = self._format[:self._data_field].sum()  # Start of data
-        e = s + d  # End of data
+    def _xbin_view(self, x, number_of_xbin):
+        """ Returns (records, bins, number_of_xbin) view of (records, channels)
 
-        # WARNING: change this to true number...
-        f0 = 15
+        Channels that do not fit are removed from the front and the back
+        """
+        r = x.shape[-1] % number_of_xbin
+        x = x[:, (r+1)//2:x.shape[-1]-r//2]
+        return x.reshape(len(x), x.shape[-1]//number_of_xbin, number_of_xbin)
 
-        # Counter
-        cf = self._raw[0][f0]
-        j = 0
-        start = True
-        count = []
-        for i in range(len(self._rawtime)):
-            t = self._rawtime[i]
-            d = self._raw[i][s:e]
-            f = self._raw[i][f0]
-            if any(d < self._error_range[0]) or any(d > self._error_range[1]):
-                continue  # Will cause error if all the last data is bad...
-
-            if j == 0:
-                self._time.append([t])
-                self._data.append(d)
-                t_old = t * 1
-                j = 1
-                start = False
-            elif not f == cf or start:
-                self._time[-1].append(t_old)
-                self._data.append(d)
-                self._time.append([t])
-                count.append(j)
-                j = 1
-                t_old = t * 1
-                self._f0.append(f)
-                cf = f * 1
-            elif i == (len(self._rawtime) - 1):
-                self._data[-1] = self._data[-1] + d
-                self._time[-1].append(t_old)
-                j += 1
-                count.append(j)
-            else:
-                self._data[-1] = self._data[-1] + d
-                j += 1
-                t_old = t * 1
-
-        # Remove running average that are not averaged
-        while len(self._time[-1]) < 2:
-            del self._data[-1]
-            del self._time[-1]
-
-        for i in range(len(self._data)):
-            first = True
-            while self._data[i].shape[0] % number_of_xbin:
-                if first:
-                    np.delete(self._data[i], 0)
-                else:
-                    np.delete(self._data[i], -1)
-                first = not first
-            s = (len(self._data[i]) // number_of_xbin, number_of_xbin)
-            self._data[i] = self._data[i].reshape(s).mean(axis=1)
+    def _xbin_array(self, x, number_of_xbin):
+        """ Averages every number_of_xbin channels of (records, channels)
 
-        # Actually average the data
-        for i in range(len(self._data)):
-            self._data[i] /= count[i]
+        Channels that do not fit are removed from the front and the back
+        """
+        return self._xbin_view(x, number_of_xbin).mean(axis=2, dtype=np.float64)
 
     def mean(self, number_of_xbin=4):
         """
@@ -561,59 +797,31 @@ class raw(_files):
         self._data_field = 1
         self._get_format(format)
 
-    def average_raw(self):
+    def average_raw(self, order='antenna'):
         """Averages a raw field and returns the vector to check for variations.
 
-        Assumes four fields in CAHA order
+        Parameters:
+            order (str or list):
+                chopper order of the records, either a mode of
+                measurements ('antenna', 'reference', 'mixed') or the
+                output of measurements.get_order()
+
+        Returns:
+            The mean of every record of each phase in the order of the
+            phases (cold, ant1, hot, ant2 in CAHA order), and the times
         """
-
-        out_cold = []
-        out_ant1 = []
-        out_hot = []
-        out_ant2 = []
-        out_t = self._rawtime
-
-        i = 0
-        while i < len(self._raw):
-            if (i % 4 == 0):
-                out_cold.append(np.mean(self._raw[i]))
-            elif (i % 4 == 1):
-                out_ant1.append(np.mean(self._raw[i]))
-            elif (i % 4 == 2):
-                out_hot.append(np.mean(self._raw[i]))
-            elif (i % 4 == 3):
-                out_ant2.append(np.mean(self._raw[i]))
-
-            i += 1
-
-        return np.array(out_cold), np.array(out_ant1), np.array(out_hot), \
-            np.array(out_ant2), out_t
+        order = phase_order(order)
+        x = self._raw_array().mean(axis=1)
+        return tuple(x[i::len(order)] for i in range(len(order))) + \
+            (self._rawtime,)
 
     def tcold(self):
-        """Averages a raw field and returns the vector to check for variations.
-
-        Assumes four fields in CAHA order
-        """
-
-        tcold = []
-
-        for x in self._raw:
-            tcold.append(x[0])
-
-        return tcold
+        """Returns the cold load temperature of every record"""
+        return self._field_array(0)[:, hkfields['cold_load']]
 
     def thot(self):
-        """Averages a raw field and returns the vector to check for variations.
-
-        Assumes four fields in CAHA order
-        """
-
-        thot = []
-
-        for x in self._raw:
-            thot.append(x[1])
-
-        return thot
+        """Returns the hot load temperature of every record"""
+        return self._field_array(0)[:, hkfields['hot_load']]
 
     def append_to_file(self, filename, time, housekeeping, data):
         """
@@ -627,29 +835,7 @@ class raw(_files):
             data (**INFO**):
                 **INFO**
         """
-        # print("appending time")
-        p = struct.pack('>I', time)
-
-        # print("appending housekeeping")
-        p += struct.pack('>'+str(self._format[0])+'f', *housekeeping)
-
-        # print("appending data")
-        p += struct.pack('>'+str(self._format[1])+'f', *data)
-
-        # print("appending noise")
-        s = self._format[-3]
-        p += struct.pack('>'+str(s)+'f', *np.zeros((s)))
-
-        # print("appending filters")
-        s = self._format[-1]+self._format[-2]
-        p += struct.pack('>'+str(s)+'f', *np.zeros((s)))
-
-        if os.path.exists(filename):
-            a = open(filename, 'ab')
-        else:
-            a = open(filename, 'wb')
-        a.write(p)
-        a.close()
+        self._writer(filename).append(time, housekeeping, data)
 
     def append_to_testfile(self, filename, time, housekeeping, data, test):
         """
@@ -663,32 +849,7 @@ class raw(_files):
             data (**INFO**):
                 **INFO**
         """
-        # print("appending time")
-        p = struct.pack('>I', time)
-
-        # print("appending housekeeping")
-        p += struct.pack('>'+str(self._format[0])+'f', *housekeeping)
-
-        # print("appending data")
-        p += struct.pack('>'+str(self._format[1])+'f', *data)
-
-        # print("appending test")
-        p += struct.pack('>'+str(self._format[2])+'i', *test)
-
-        # print("appending noise")
-        s = self._format[-3]
-        p += struct.pack('>'+str(s)+'f', *np.zeros((s)))
-
-        # print("appending filters")
-        s = self._format[-1]+self._format[-2]
-        p += struct.pack('>'+str(s)+'f', *np.zeros((s)))
-
-        if os.path.exists(filename):
-            a = open(filename, 'ab')
-        else:
-            a = open(filename, 'wb')
-        a.write(p)
-        a.close()
+        self._writer(filename).append(time, housekeeping, data, test)
 
     def append_to_swictsfile(self, filename, time, housekeeping, data):
         """
@@ -702,21 +863,362 @@ class raw(_files):
             data (**INFO**):
                 **INFO**
         """
-        # print("appending time")
-        p = struct.pack('>I', time)
+        # Only time, housekeeping and data are written
+        format = '>i{}f{}f'.format(self._format[0], self._format[1])
+        self._writer(filename, format).append(time, housekeeping, data)
 
-        # print("appending housekeeping")
-        p += struct.pack('>'+str(self._format[0])+'f', *housekeeping)
+    def _writer(self, filename, format=None):
+        """ Returns the open writer of filename, closing any other """
+        writer = getattr(self, '_open_writer', None)
+        if writer is not None and writer.filename == filename:
+            return writer
 
-        # print("appending data")
-        p += struct.pack('>'+str(self._format[1])+'f', *data)
+        if writer is not None:
+            writer.close()
+        self._open_writer = raw_writer(filename, format or self._struct.format,
+                                       **getattr(self, '_writer_policy', {}))
+        return self._open_writer
+
+    def set_flush_policy(self, flush_records=64, flush_time=5.0):
+        """ Sets how often appended records are written to disk
+
+        By default every record is written by its append_to_* call.
+        With a policy, records are kept in memory until flush_records of
+        them are kept or flush_time has passed, and close writes the rest
+
+        Parameters:
+            flush_records (int):
+                Number of records kept in memory before writing
+            flush_time (float):
+                Seconds after which records are written anyway
+        """
+        self._writer_policy = {'flush_records': flush_records,
+                               'flush_time': flush_time}
+        self.close()
+
+    def close(self):
+        """ Writes and closes the file of the append_to_* methods """
+        writer = getattr(self, '_open_writer', None)
+        if writer is not None:
+            writer.close()
+        self._open_writer = None
+
+
+class raw_index:
+    """ Sparse time index of a raw file
+
+        The index keeps the size and number of records of the file,
+        its first and last time, and the time of every step:th record.
+        It is saved next to the file as filename + ".idx" and updated
+        when the file has grown since it was saved.  A saved index is
+        only used if the file still has its first and last time at the
+        indexed records, and it is kept in memory only if it cannot be
+        saved, e.g., in a read-only archive.  The times of the file must
+        not decrease.
+
+        Input:
+            filename: name of the raw file
+
+            format: record format of the file, e.g. eform
+
+            step: number of records between the indexed times
+    """
+    def __init__(self, filename, format=eform, step=64):
+        self.filename = filename
+        self.indexname = filename + '.idx'
+        self.step = step
+        self._dtype = format_dtype(format)
+        self._size = self._dtype.itemsize
+        self.update()
+
+    def __len__(self):
+        return self.n
+
+    def update(self):
+        """ Reads the index, and updates it if the file has changed """
+        s = os.stat(self.filename).st_size
+        if s % self._size:
+            raise RuntimeError("Error in reading file. Wrong bitcount")
+        n = s // self._size
+
+        self.n = 0
+        self.times = np.zeros(0, dtype=np.int64)
+        self.first = self.last = None
+        try:
+            with np.load(self.indexname) as x:
+                m = int(x['n'])
+                if int(x['size']) == self._size and \
+                        int(x['step']) == self.step and 0 < m <= n:
+                    t = self._times()
+                    if t[0] == int(x['first']) and t[m-1] == int(x['last']):
+                        self.n = m
+                        self.times = x['times']
+                        self.first = int(x['first'])
+                        self.last = int(x['last'])
+        except (OSError, KeyError, ValueError, EOFError,
+                zipfile.BadZipFile):
+            pass
+
+        if n == self.n:
+            return
+
+        # Index the new records
+        t = self._times()
+        k0 = (self.n + self.step - 1) // self.step
+        self.times = np.append(self.times, t[k0*self.step:n:self.step])
+        self.n = n
+        self.first = int(t[0])
+        self.last = int(t[-1])
+
+        # Written to a temporary file and renamed, so readers never see a
+        # partial index
+        tmpname = self.indexname + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmpname, 'wb') as file:
+                np.savez(file, size=self._size, step=self.step, n=self.n,
+                         times=self.times, first=self.first, last=self.last)
+            os.replace(tmpname, self.indexname)
+        except OSError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def records(self, t0, t1):
+        """ Returns the range of records with t0 <= time < t1
+
+        Output:
+            r0: first record in the range
+
+            r1: record after the last record in the range
+        """
+        return self._record(t0), self._record(t1)
+
+    def _record(self, t):
+        """ First record with time at or after t """
+        k = np.searchsorted(self.times, t, side='left')
+        if k == 0:
+            return 0
+
+        # Between the indexed records k-1 and k
+        r0 = (k-1) * self.step
+        r1 = min(k * self.step, self.n)
+        return r0 + int(np.searchsorted(self._times()[r0:r1], t,
+                                        side='left'))
+
+    def _times(self):
+        """ Mapped times of all records """
+        return np.memmap(self.filename, dtype=self._dtype, mode='r')['time']
+
+
+class raw_writer:
+    """ Appends records to a raw file that is kept open
+
+        The records are packed into a preallocated buffer of the record
+        format and written when it is full or when flush_time seconds
+        have passed since the last write.  The file is synced to disk
+        when the writer is closed, i.e., at the rollover to a new file.
+        Buffered records are also written when the writer is deleted.
+
+        Input:
+            filename: name of the file, appended to if it exists
+
+            format: record format, e.g. eform
+
+            flush_records: records kept in memory before writing, the
+                           default 1 writes every record as it comes
+
+            flush_time: seconds after which the records are written
+    """
+    def __init__(self, filename, format=eform, flush_records=1,
+                 flush_time=5.0):
+        assert format[0] == '>', "Must use big-endian to read and store data"
+        assert format[1] == 'i', "Must use index time-stamp as first variable"
+        assert flush_records > 0, "Must keep at least one record"
+
+        self.filename = filename
+        self.flush_time = flush_time
+        self._buffer = np.zeros(flush_records, dtype=format_dtype(format))
+        self._n = 0
+        self._t0 = time.time()
+        self._file = open(filename, 'ab')
+
+    def __repr__(self):
+        return self.filename
+    __str__ = __repr__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_file', None) is not None:
+            self.close()
+
+    def append(self, t, *fields):
+        """ Appends a record
+
+        Input:
+            t: time of the record
+
+            fields: values of the fields of the format in order.  Fields
+                    that are not given are written as zeroes
+        """
+        assert self._file is not None, "Writer is closed"
+        record = self._buffer[self._n]
+        record['time'] = t
+        for i, x in enumerate(fields):
+            name = 'field' + str(i)
+            x = np.asarray(x)
+            assert x.size == record[name].size, \
+                "Bad size {} of {}".format(x.size, name)
+            record[name] = x
+        self._n += 1
+
+        if self._n == len(self._buffer) or \
+                (time.time() - self._t0) >= self.flush_time:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered records to the file """
+        if self._n:
+            self._file.write(memoryview(self._buffer[:self._n]).cast('B'))
+            self._buffer[:self._n] = 0
+            self._n = 0
+        self._file.flush()
+        self._t0 = time.time()
+
+    def close(self):
+        """ Writes the buffered records and syncs the file to disk """
+        if self._file is None:
+            return
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+
+class _raw_nc_lock:
+    """ Coordination of the writer and the readers of a raw_nc file
+
+        The file filename + ".lock" holds a count of the starts and ends
+        of the writes of the netcdf file, so the count is odd while the
+        writer writes.  The writer holds an exclusive flock of the lock
+        file while it writes if it can take it at once, and readers hold
+        a shared flock while they read.  So the writer never waits for
+        the flock of readers, readers only wait for a write in progress,
+        and a reader reads again if the count changed while it read,
+        i.e., if the writer wrote anyway.
+
+        A file without a lock file, such as a file in an archive that
+        cannot be written, is read as it is.  Without fcntl there is no
+        flock, only the count.
+
+        Input:
+            filename: name of the netcdf file
+    """
+    def __init__(self, filename):
+        self.filename = filename + '.lock'
+        self.locked = False
+        self._fd = None
+        self._rfd = None
+
+    def begin(self, force=True):
+        """ Starts a write, unless readers hold the lock and not force
+
+        Returns True if the write is started
+        """
+        if self._fd is None:
+            self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.locked = True
+            except OSError:
+                if not force:
+                    return False
+
+        count = _lock_count(self._fd)
+        os.pwrite(self._fd, struct.pack('<q', count + 1 + count % 2), 0)
+        return True
+
+    def end(self):
+        """ Ends a write and releases the lock """
+        os.pwrite(self._fd, struct.pack('<q', _lock_count(self._fd) + 1), 0)
+        if self.locked:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.locked = False
+
+    def close(self):
+        """ Closes the lock file of the writer """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self.locked = False
+
+    def count(self):
+        """ Returns the count within "read", or None without lock file """
+        return None if self._rfd is None else _lock_count(self._rfd)
+
+    def read(self, func, tries=100):
+        """ Returns func() read under the shared lock
+
+        A count that stays the same odd count, of a writer that died
+        while writing, is waited for about tries/100 seconds before the
+        file is read anyway, and a read is done again at most tries times
+        when the writer wrote while it read
+        """
+        try:
+            self._rfd = os.open(self.filename, os.O_RDONLY)
+        except OSError:
+            return func()
+
+        try:
+            waits = reads = 0
+            odd = None
+            while reads < tries:
+                if fcntl is not None:
+                    fcntl.flock(self._rfd, fcntl.LOCK_SH)
+                try:
+                    count = _lock_count(self._rfd)
+                    if count % 2 == 0 or waits == tries - 1:
+                        reads += 1
+                        try:
+                            out = func()
+                        except Exception:
+                            if _lock_count(self._rfd) == count:
+                                raise
+                        else:
+                            if _lock_count(self._rfd) == count:
+                                return out
+                    else:
+                        waits = waits + 1 if count == odd else 0
+                        odd = count
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(self._rfd, fcntl.LOCK_UN)
+
+                # Only a write without the lock, which is short, gets here
+                time.sleep(0.01)
+        finally:
+            os.close(self._rfd)
+            self._rfd = None
+        raise RuntimeError("Cannot read {} while it is written".format(
+                self.filename[:-5]))
+
+
+def _lock_count(fd):
+    """ Returns the count of lock file fd, see _raw_nc_lock """
+    count = os.pread(fd, 8, 0)
+    return struct.unpack('<q', count)[0] if len(count) == 8 else 0
+
+
+# netCDF4 and HDF5 are not thread safe, so the raw_nc files of all threads
+# of the process make their netcdf calls holding this lock.  It is taken
+# after, and never held while waiting for, the flock of a _raw_nc_lock
+_nc_lock = threading.RLock()
 
-        if os.path.exists(filename):
-            a = open(filename, 'ab')
-        else:
-            a = open(filename, 'wb')
-        a.write(p)
-        a.close()
 
 class raw_nc:
     """ Class for saving raw data to netcdf format
@@ -726,14 +1228,68 @@ class raw_nc:
 
         Subsequent calls appends to the file.
 
+        With keep_open, the file is opened once and kept open between
+        calls to "save".  The records are then kept in memory and
+        written, the file synced and the "pos" and "end_time" attributes
+        published, every sync_records records or sync_time seconds, and
+        when "sync" or "close" is called.
+
+        The variables are created with the chunking and compression
+        of a storage profile, see storage_profiles.
+
+        One writer and any number of readers may use the file at the
+        same time, coordinated by the file filename + ".lock", see
+        _raw_nc_lock.  Within a process the netcdf calls of all files
+        are made one at a time, so the files may be used from several
+        threads.  The writer does not wait for the lock: without
+        keep_open every record is written before "save" returns, and
+        readers reading then read again, so the writer only waits for
+        reads in progress to close the file.  With keep_open, a write
+        that finds readers reading is put off until sync_records more
+        records are saved, and is then done anyway.  Readers always see the "pos" of records fully
+        written, so read only the committed records of a live file, see
+        get_committed.  Readers in other processes can only open a file
+        kept open by the writer if the process of the writer runs with
+        the environment variable HDF5_USE_FILE_LOCKING=FALSE, as HDF5
+        otherwise locks the file while it is open.
+
         Input:
             filename: name of new file to save data within
+
+            size: number of records of the file
+
+            keep_open: keep the file open between calls to "save"
+
+            sync_records: records between syncs if keep_open
+
+            sync_time: seconds between syncs if keep_open
+
+            storage: name of a storage profile or a dict like one
     """
-    def __init__(self, filename, size=None):
+    def __init__(self, filename, size=None, keep_open=False, sync_records=12,
+                 sync_time=5.0, storage='default'):
         self.filename = filename
         self.new = True
         self.size = size
+        self.storage = storage_profiles[storage] \
+            if isinstance(storage, str) else storage
         self.pos = 0
+        self.keep_open = keep_open
+        self.sync_records = sync_records
+        self.sync_time = sync_time
+        self._dataset = None
+        self._session = None
+        self._meta = None
+        self._lock = _raw_nc_lock(filename)
+        self._pending = []
+        self._keys = None
+        self._written = 0
+        self._synced = time.time()
+
+    def __del__(self):
+        if getattr(self, '_pending', None) or \
+                getattr(self, '_dataset', None) is not None:
+            self.close()
 
     def __repr__(self):
         return self.filename
@@ -758,86 +1314,253 @@ class raw_nc:
 
             source: attribute added to netcdf if not None
 
+            recordslen: number of spectras in data["record"]
         """
-        assert self.size is not None, "Need to initialize size"
+        self.save_many({key: np.reshape(data[key], (1, -1)) for key in data},
+                       source, recordslen)
 
-        t0 = time.time()
-        now = datetime.datetime.fromtimestamp(t0).strftime("%Y-%m-%d %H:%M:%S")
+    def save_many(self, data, source=None, recordslen=1):
+        """ Save dict of data of several records to file
 
-        while (time.time() - t0) < 5:
-            try:
-                f = nc.Dataset(self.filename, 'w' if self.new else 'a')
-                break
-            except:
-                time.sleep(0.1)  # Sleeps for half the time that read-access sleeps for
+        As "save", but every entry of data has the records first, and
+        all records are written by one slice assignment per variable
 
-        try:
-            if source is not None:
-                f.source = source
-        except:
-            raise RuntimeError("Tried reading file {} for 5 seconds but cannot open it".format(self.filename))
+        Input:
+            data: dict of data to be stored, entries of shape
+            (records, ...), of the variables of the first save or some
+            of them
 
-        if self.new:
-            f.createDimension('records', self.size)
-            f.createDimension('spectras', recordslen)
+            source: attribute added to netcdf if not None
 
-            dims = []
-            input = []
-            for key in data:
-                if len(data[key]) not in dims:
-                    dims.append(len(data[key]))
-                    if len(data[key]) == 1:
-                        f.createDimension('one', 1)
-                    elif len(data[key]) == 2:
-                        f.createDimension('two', 2)
-                    elif key == 'record':
-                        f.createDimension('channels', len(data[key])//recordslen)
-                    else:
-                        f.createDimension('n' + key, len(data[key]))
+            recordslen: number of spectras in data["record"]
+        """
+        assert self.size is not None, "Need to initialize size"
 
-                if len(data[key]) == 1:
-                    input.append(f.createVariable(key, type(data[key][0]), ('records', 'one')))
-                elif len(data[key]) == 2:
-                    input.append(f.createVariable(key, type(data[key][0]), ('records', 'two')))
-                elif key == 'record':
-                    input.append(f.createVariable(key, type(data[key][0]), ('records', 'spectras', 'channels')))
-                else:
-                    input.append(f.createVariable(key, type(data[key][0]), ('records', 'n'+key)))
+        data = {key: np.reshape(data[key], (len(data[key]), -1)) for key in data}
+        records = {len(data[key]) for key in data}
+        if len(records) != 1:
+            raise RuntimeError("Need data of the same number of records, got {}".format(sorted(records)))
+        if self._keys is None:
+            self._keys = set(data)
+        elif not set(data) <= self._keys:
+            raise RuntimeError("Cannot save {} not saved first to {}".format(sorted(set(data) - self._keys), self.filename))
+
+        # The kept records are written together, so of the same variables
+        if self._pending and set(data) != set(self._pending[-1][0]):
+            self._flush()
+        self._pending.append((data, source, recordslen, time.time()))
+        self.pos += records.pop()
+
+        # Records are written at once, or every sync_records records with
+        # keep_open, when they may be put off for sync_records more records
+        n = self.pos - self._written
+        if not self.keep_open:
+            self._flush()
+        elif n >= self.sync_records or \
+                (time.time() - self._synced) >= self.sync_time:
+            self._flush(force=n >= 2 * self.sync_records)
+
+    def sync(self):
+        """ Writes the records saved so far and commits them to readers
+
+        With keep_open the file is synced and "pos" and "end_time" are
+        published
+        """
+        self._flush()
 
-            f.start_time = now
+    def close(self):
+        """ Writes the records saved so far and closes a kept open file """
+        try:
+            self._flush()
+            if self._dataset is not None:
+                self._lock.begin()
+                try:
+                    with _nc_lock:
+                        self._dataset.close()
+                finally:
+                    self._dataset = None
+                    self._lock.end()
+        finally:
+            self._lock.close()
+
+    def _flush(self, force=True):
+        """ Writes the kept records unless readers read and not force """
+        if not self._pending:
+            return
+        if not self._lock.begin(force):
+            return
 
-        for key in data:
-            var = f.variables[key]
+        try:
+            with _nc_lock:
+                self._write()
+        finally:
+            self._lock.end()
+            if not self.keep_open:
+                self._lock.close()
+
+    def _write(self):
+        """ Writes the kept records, then publishes "pos" """
+        pending = self._pending
+        data = {key: np.concatenate([p[0][key] for p in pending])
+                for key in pending[0][0]}
+        source = [p[1] for p in pending if p[1] is not None]
+        recordslen = pending[0][2]
+        start = datetime.datetime.fromtimestamp(pending[0][3]).strftime("%Y-%m-%d %H:%M:%S")
+        now = datetime.datetime.fromtimestamp(pending[-1][3]).strftime("%Y-%m-%d %H:%M:%S")
+        m = sum(len(next(iter(p[0].values()))) for p in pending)
+
+        f = self._dataset
+        if f is None:
+            _close_sessions(self.filename)
+            f = self._open()
 
-            if key == 'record':
-                var[self.pos] = np.reshape(np.nan_to_num(data[key]), (recordslen, len(data[key])//recordslen))
-            else:
-                var[self.pos] = np.nan_to_num(data[key])
+        try:
+            if source:
+                f.source = source[-1]
 
-        f.end_time = now
+            if self.new:
+                self._create(f, data, recordslen)
+                f.start_time = start
 
-        f.pos = self.pos
-        f.close()
+            for key in data:
+                var = f.variables[key]
+                var[self._written:self._written+m] = np.reshape(
+                        np.nan_to_num(data[key]), (m, ) + var.shape[1:])
+
+            if self.keep_open:
+                f.sync()
+            f.end_time = now
+            f.pos = self._written + m - 1
+            if self.keep_open:
+                f.sync()
+        except:
+            if not self.keep_open:
+                f.close()
+            raise
 
-        self.pos += 1
+        if self.keep_open:
+            self._dataset = f
+        else:
+            f.close()
+
+        self._pending = []
+        self._written += m
+        self._synced = time.time()
         self.new = False
 
-    def save_full(self, data, source=None):
-        now = datetime.datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d %H:%M:%S")
+    def _open(self, tries=500):
+        """ Opens the file for writing
+
+        Readers in other processes may have the file open for the read
+        they are in, which new reads wait for, so it is tried again for
+        about tries/100 seconds
+        """
+        for i in range(tries):
+            try:
+                return nc.Dataset(self.filename, 'w' if self.new else 'a')
+            except Exception:
+                time.sleep(0.01)
+        raise RuntimeError("Cannot open {}".format(self.filename))
+
+    def _create(self, f, data, recordslen):
+        """ Creates dimensions and variables of the first records in f """
+        f.createDimension('records', self.size)
+        f.createDimension('spectras', recordslen)
 
-        f = nc.Dataset(self.filename, 'w')
+        dims = []
+        for key in data:
+            n = data[key].shape[1]
+            dtype = data[key].dtype.type
+            if n not in dims:
+                dims.append(n)
+                if n == 1:
+                    f.createDimension('one', 1)
+                elif n == 2:
+                    f.createDimension('two', 2)
+                elif key == 'record':
+                    f.createDimension('channels', n//recordslen)
+                else:
+                    f.createDimension('n' + key, n)
 
-        if source is not None:
-            f.source = source
+            if n == 1:
+                self._create_variable(f, key, dtype, ('records', 'one'))
+            elif n == 2:
+                self._create_variable(f, key, dtype, ('records', 'two'))
+            elif key == 'record':
+                self._create_variable(f, key, dtype, ('records', 'spectras', 'channels'))
+            else:
+                self._create_variable(f, key, dtype, ('records', 'n'+key))
 
+    def save_full(self, data, source=None):
         n = self.size
         for key in data:
             if data[key].shape[0] != n:
                 raise RuntimeError("Bad sizes, size input {} does not match size of \"{}\", which is {}".format(n, key, data[key].shape[0]))
 
+        self.save_chunks([data], source)
+
+    def save_chunks(self, chunks, source=None):
+        """ Save dicts of data to a new file, chunk by chunk
+
+        The first chunk sets the variables as for save_full, and
+        every chunk is written after the previous one along the
+        records.  The chunks must add up to self.size records.
+
+        NaN inputs are turned into standard np.nan_to_num
+
+        Input:
+            chunks: iterable of dicts of data, like for save_full
+
+            source: attribute added to netcdf if not None
+        """
+        self._lock.begin()
+        try:
+            with _nc_lock:
+                _close_sessions(self.filename)
+                f = nc.Dataset(self.filename, 'w')
+
+                if source is not None:
+                    f.source = source
+
+            n = self.size
+            pos = 0
+            for data in chunks:
+                m = data['time'].shape[0]
+                with _nc_lock:
+                    if not pos:
+                        self._create_full(f, data, n)
+                        start_time = data['time'][0, 0]
+
+                    if pos + m > n:
+                        f.close()
+                        raise RuntimeError("Bad sizes, more than {} records".format(n))
+
+                    for key in data:
+                        var = f.variables[key]
+                        var[pos:pos+m] = np.reshape(np.nan_to_num(data[key]),
+                                                    (m, ) + var.shape[1:])
+                end_time = data['time'][-1, 0]
+                pos += m
+
+            with _nc_lock:
+                if pos != n:
+                    f.close()
+                    raise RuntimeError("Bad sizes, size input {} does not match {} records saved".format(n, pos))
+
+                f.start_time = datetime.datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S")
+                f.end_time = datetime.datetime.fromtimestamp(end_time).strftime("%Y-%m-%d %H:%M:%S")
+
+                f.close()
+        finally:
+            self._lock.end()
+            self._lock.close()
+
+        self.new = False
+
+    def _create_full(self, f, data, n):
+        """ Creates dimensions and variables of n records for data in f """
         f.createDimension('records', n)
         dims = []
-        input = []
 
         for key in data:
             if data[key].shape[-1] not in dims:
@@ -857,194 +1580,437 @@ class raw_nc:
                     f.createDimension('n' + key, data[key].shape[-1])
 
             if data[key].shape[-1] == 1:
-                input.append(f.createVariable(key, type(data[key][0, 0]), ('records', 'one')))
+                self._create_variable(f, key, type(data[key][0, 0]), ('records', 'one'))
             elif data[key].shape[-1] == 2:
-                input.append(f.createVariable(key, type(data[key][0, 0]), ('records', 'two')))
+                self._create_variable(f, key, type(data[key][0, 0]), ('records', 'two'))
             elif key == 'record':
-                input.append(f.createVariable(key, type(data[key][0, 0]), ('records', 'spectras', 'channels')))
+                self._create_variable(f, key, type(data[key][0, 0]), ('records', 'spectras', 'channels'))
             else:
-                input.append(f.createVariable(key, type(data[key][0, 0]), ('records', 'n'+key)))
+                self._create_variable(f, key, type(data[key][0, 0]), ('records', 'n'+key))
 
-            input[-1][:] = np.nan_to_num(data[key])
+    def _create_variable(self, f, key, type, dims):
+        """ Creates a variable in f with the storage profile """
+        storage = dict(self.storage)
+        chunk_bytes = storage.pop('chunk_bytes', None)
+        if key != 'record':
+            storage.pop('least_significant_digit', None)
 
-        f.start_time = datetime.datetime.fromtimestamp(data['time'][0, 0]).strftime("%Y-%m-%d %H:%M:%S")
-        f.end_time = datetime.datetime.fromtimestamp(data['time'][-1, 0]).strftime("%Y-%m-%d %H:%M:%S")
+        if chunk_bytes is not None:
+            shape = [f.dimensions[dim].size for dim in dims]
+            n = max(1, chunk_bytes // (np.dtype(type).itemsize *
+                                       int(np.prod(shape[1:]))))
+            storage['chunksizes'] = [min(n, shape[0])] + shape[1:]
 
-        f.close()
-
-        self.new = False
+        return f.createVariable(key, type, dims, **storage)
 
     def append_attribute(self, attr, attr_value):
-        t0 = time.time()
-        while (time.time() - t0) < 5:
-            try:
+        self._flush()
+        if self._dataset is not None:
+            with _nc_lock:
+                self._dataset.__setattr__(attr, attr_value)
+            return 0
+
+        self._lock.begin()
+        try:
+            with _nc_lock:
+                _close_sessions(self.filename)
                 data = nc.Dataset(self.filename, 'r+')
                 data.__setattr__(attr, attr_value)
                 data.close()
-                return 0
-            except:
-                time.sleep(0.1)
-        raise RuntimeError("Cannot comply with command")
+            return 0
+        except Exception:
+            raise RuntimeError("Cannot comply with command")
+        finally:
+            self._lock.end()
+            self._lock.close()
+
+    def session(self):
+        """ Returns a context in which the file is kept open for reading
+
+        Within the context the query methods use the open file, and the
+        dimension, variable and attribute metadata read when the context
+        is entered.  Nested contexts use the outer one.
+
+        No lock is held between the reads of the context.  A read that
+        finds that the writer of a live file wrote since the file was
+        opened opens it again, but keeps the metadata, which are of
+        records already written.
+
+        Example:
+            >>> with rawfile.session():
+            >>>     n = rawfile.get_pos()
+            >>>     x = rawfile.get_variable("record", n)
+        """
+        return _raw_nc_session(self)
 
-    def __len__(self):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
+    def _read(self, func, cached=None):
+        """ Returns func(dataset), or cached(metadata) in a session
+
+        Outside of a session the file is opened for the call, see
+        _raw_nc_lock.read, or the open file of a writer keeping it open
+        is used
+        """
+        if self._session is not None:
+            if cached is not None:
+                return cached(self._meta)
+            return self._session.read(func)
+
+        if self._dataset is not None:
             try:
-                data = nc.Dataset(self.filename, 'r')
-                n = data.dimensions['records'].size
-                data.close()
-                return n
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+                with _nc_lock:
+                    return func(self._dataset)
+            except Exception:
+                raise RuntimeError("Cannot comply with command")
+
+        def read():
+            with _nc_lock:
+                try:
+                    data = nc.Dataset(self.filename, 'r')
+                except Exception:
+                    raise RuntimeError("Cannot open {}".format(self.filename))
+                try:
+                    return func(data)
+                except Exception:
+                    raise RuntimeError("Cannot comply with command")
+                finally:
+                    data.close()
+        return self._lock.read(read)
+
+    def __len__(self):
+        return self.get_dimension('records')
 
     def __repr__(self):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                s = str(data)
-                data.close()
-                return s
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: str(data))
 
     __str__ = __repr__
 
     def get_variable(self, var, pos1=None, pos2=None):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                if pos1 is not None:
-                    if pos2 is not None:
-                        x = data.variables[var][pos1, pos2]
-                    else:
-                        x = data.variables[var][pos1]
-                elif pos2 is not None:
-                    x = data.variables[var][:, pos2]
+        def read(data):
+            if pos1 is not None:
+                if pos2 is not None:
+                    return data.variables[var][pos1, pos2]
                 else:
-                    x = data.variables[var][:]
-                data.close()
-                return x
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+                    return data.variables[var][pos1]
+            elif pos2 is not None:
+                return data.variables[var][:, pos2]
+            else:
+                return data.variables[var][:]
+        return self._read(read)
 
     def has_variable(self, var):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                x = var in data.variables
-                data.close()
-                return x
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: var in data.variables,
+                          lambda meta: var in meta['variables'])
 
     def variables(self):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                x = list(data.variables.keys())
-                data.close()
-                return x
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: list(data.variables.keys()),
+                          lambda meta: list(meta['variables'].keys()))
 
     def variable_dimensions(self, var):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                x = data.variables[var].dimensions
-                data.close()
-                return x
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: data.variables[var].dimensions,
+                          lambda meta: meta['variables'][var][0])
 
     def variable_dtype(self, var):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                x = data.variables[var].dtype
-                data.close()
-                return x
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: data.variables[var].dtype,
+                          lambda meta: meta['variables'][var][1])
 
     def get_dimension(self, dim):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                d = data.dimensions[dim].size
-                data.close()
-                return d
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: data.dimensions[dim].size,
+                          lambda meta: meta['dimensions'][dim])
 
     def has_dimension(self, dim):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                d = dim in data.dimensions
-                data.close()
-                return d
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: dim in data.dimensions,
+                          lambda meta: dim in meta['dimensions'])
 
     def dimensions(self):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                d = list(data.dimensions.keys())
-                data.close()
-                return d
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: list(data.dimensions.keys()),
+                          lambda meta: list(meta['dimensions'].keys()))
 
     def get_attribute(self, attr):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                a = data.__getattribute__(attr)
-                data.close()
-                return a
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: data.__getattribute__(attr),
+                          lambda meta: meta['attributes'][attr])
 
     def has_attribute(self, attr):
-        t0 = time.time()
-        while (time.time() - t0) < 10:
-            try:
-                data = nc.Dataset(self.filename, 'r')
-                a = attr in dir(data)
-                data.close()
-                return a
-            except:
-                time.sleep(0.2)
-        raise RuntimeError("Cannot comply with command")
+        return self._read(lambda data: attr in dir(data),
+                          lambda meta: attr in meta['attributes'])
 
     def get_pos(self):
         return self.get_attribute('pos') if self.has_attribute('pos') else (self.get_dimension("records") - 1)
 
+    def committed(self):
+        """ Returns the number of records committed by the writer """
+        return self._read(_committed,
+                          lambda meta: meta['attributes']['pos'] + 1
+                          if 'pos' in meta['attributes']
+                          else meta['dimensions']['records'])
+
+    def get_committed(self, var):
+        """ Returns the records of var committed by the writer
+
+        The number of records and the records are read from the same
+        open file, so this is safe to call while the file is written
+        """
+        return self._read(lambda data: data.variables[var][:_committed(data)])
+
+
+def _committed(data):
+    """ Returns the committed records of open raw_nc file data """
+    return data.pos + 1 if 'pos' in data.ncattrs() \
+        else data.dimensions['records'].size
+
+
+# Open read sessions of this process by file
+_sessions = {}
+
+
+def _close_sessions(filename):
+    """ Closes the files of the sessions of filename in this process
+
+    HDF5 cannot open a file for writing that the process has open for
+    reading, and the sessions open it again when they read
+    """
+    with _nc_lock:
+        for x in _sessions.get(os.path.abspath(filename), []):
+            if x.data is not None:
+                x.data.close()
+                x.data = None
+
+
+class _raw_nc_session:
+    """ Read session of a raw_nc, see raw_nc.session """
+    def __init__(self, rawfile):
+        self.rawfile = rawfile
+        self.outer = False
+        self.lock = _raw_nc_lock(rawfile.filename)
+        self.data = None
+        self.count = None
+
+    def __enter__(self):
+        self.outer = self.rawfile._session is not None
+        if self.outer:
+            return self.rawfile
+
+        # Registered before the file is opened, so a writer of another
+        # thread closes it before writing
+        with _nc_lock:
+            _sessions.setdefault(os.path.abspath(self.rawfile.filename), []).append(self)
+        try:
+            self.rawfile._meta = self.lock.read(self._open)
+        except Exception:
+            self._close()
+            raise
+        self.rawfile._session = self
+        return self.rawfile
+
+    def __exit__(self, *args):
+        if self.outer:
+            return
+        self._close()
+        self.rawfile._session = None
+        self.rawfile._meta = None
+
+    def _close(self):
+        """ Closes the file and ends the session """
+        with _nc_lock:
+            if self.data is not None:
+                self.data.close()
+                self.data = None
+            sessions = _sessions[os.path.abspath(self.rawfile.filename)]
+            sessions.remove(self)
+            if not sessions:
+                del _sessions[os.path.abspath(self.rawfile.filename)]
+
+    def read(self, func):
+        """ Returns func(dataset), opening the file again if written """
+        def read():
+            with _nc_lock:
+                if self.data is None or self.lock.count() != self.count:
+                    self._open()
+                try:
+                    return func(self.data)
+                except Exception:
+                    raise RuntimeError("Cannot comply with command")
+        return self.lock.read(read)
+
+    def _open(self):
+        """ Opens the file and returns its metadata """
+        with _nc_lock:
+            if self.data is not None:
+                self.data.close()
+                self.data = None
+            try:
+                data = self.data = nc.Dataset(self.rawfile.filename, 'r')
+            except Exception:
+                raise RuntimeError("Cannot open {}".format(self.rawfile.filename))
+            self.count = self.lock.count()
+
+            return {'dimensions': {k: v.size for k, v in data.dimensions.items()},
+                    'variables': {k: (v.dimensions, v.dtype)
+                                  for k, v in data.variables.items()},
+                    'attributes': dict(data.__dict__)}
+
+
+class raw_nc_buffer:
+    """ Buffers the records saved to a raw_nc in memory
+
+        The records of "save" are kept until the given number of
+        chopper cycles is collected, and are then saved by one call
+        to raw_nc.save_many.  Buffered records are lost if the program
+        dies before they are flushed.
+
+        Input:
+            rawfile: the raw_nc to save to
+
+            cycles: number of chopper cycles to buffer
+
+            cycle_records: records of a chopper cycle
+    """
+    def __init__(self, rawfile, cycles=4, cycle_records=4):
+        self.rawfile = rawfile
+        self.filename = rawfile.filename
+        self.records = cycles * cycle_records
+        self._buffer = []
+
+    def __repr__(self):
+        return self.filename
+    __str__ = __repr__
+
+    @property
+    def pos(self):
+        """ Number of records saved, buffered or not """
+        return self.rawfile.pos + len(self._buffer)
+
+    def save(self, data, source=None, recordslen=1):
+        """ Buffers dict of data, see raw_nc.save """
+        self._buffer.append(({key: np.array(data[key]) for key in data},
+                             source, recordslen))
+        if len(self._buffer) >= self.records:
+            self.flush()
+
+    def flush(self):
+        """ Saves the buffered records """
+        if not self._buffer:
+            return
+
+        data = {key: np.stack([np.ravel(b[0][key]) for b in self._buffer])
+                for key in self._buffer[0][0]}
+        self.rawfile.save_many(data, self._buffer[-1][1], self._buffer[0][2])
+        self._buffer = []
+
+    def close(self):
+        """ Saves the buffered records and closes the raw_nc """
+        self.flush()
+        self.rawfile.close()
+
+
+class raw_nc_thread:
+    """ Saves the records saved to a raw_nc in a thread of its own
+
+        "save" puts the record in a queue of at most queue_records
+        records and returns at once unless the queue is full.  The
+        thread takes ownership of the arrays of the record, so they
+        must not be changed after "save", but the dict may be reused.
+
+        An error of the thread is raised as a RuntimeError by the next
+        call to "save" or "close".  "stats" returns the back-pressure
+        metrics of the queue.
 
-def raw2nc(record, datapos, fname_in, fname_out):
+        The threads of several files may run at once, their netcdf
+        calls are made one at a time, see raw_nc.
+
+        Input:
+            rawfile: the raw_nc, or raw_nc_buffer, to save to
+
+            queue_records: size of the queue
+    """
+    def __init__(self, rawfile, queue_records=64):
+        self.rawfile = rawfile
+        self.filename = rawfile.filename
+        self.pos = rawfile.pos
+        self._queue = queue.Queue(queue_records)
+        self._error = None
+        self._closing = False
+        self._stats = {'records': 0, 'max_depth': 0, 'max_latency': 0.0,
+                       'full': 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return self.filename
+    __str__ = __repr__
+
+    def save(self, data, source=None, recordslen=1):
+        """ Queues dict of data, see raw_nc.save """
+        self._raise()
+
+        if self._queue.full():
+            self._stats['full'] += 1
+        self._queue.put((time.time(), dict(data), source, recordslen))
+        self._stats['max_depth'] = max(self._stats['max_depth'],
+                                       self._queue.qsize())
+        self.pos += 1
+
+    def stats(self):
+        """ Returns a dict of the back-pressure metrics
+
+        records: records saved by the thread
+
+        depth: records in the queue
+
+        max_depth: most records in the queue after a save
+
+        max_latency: longest time in seconds from save to saved
+
+        full: saves that had to wait for the queue
+        """
+        return dict(self._stats, depth=self._queue.qsize())
+
+    def close(self, wait=True):
+        """ Saves the queued records and closes the raw_nc
+
+        Without wait the thread is only told to close the file after
+        the queued records, and "close" must be called again, when
+        "done" or to wait for it, to raise its errors
+        """
+        if not self._closing:
+            self._closing = True
+            self._queue.put(None)
+        if wait:
+            self._thread.join()
+            self._raise()
+
+    def done(self):
+        """ Returns True if the thread has closed the raw_nc """
+        return not self._thread.is_alive()
+
+    def _raise(self):
+        if self._error is not None:
+            raise RuntimeError("Saving to {} failed: {}".format(self.filename, self._error))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+
+            try:
+                t, data, source, recordslen = item
+                self.rawfile.save(data, source, recordslen)
+                self._stats['records'] += 1
+                self._stats['max_latency'] = max(self._stats['max_latency'],
+                                                 time.time() - t)
+            except Exception as e:
+                self._error = e
+
+        try:
+            self.rawfile.close()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+
+
+def raw2nc(record, datapos, fname_in, fname_out, chunk_records=1024):
     """ Converts a raw file to a netcdf file
 
         Takes a file of standard raw-form, which is a single 32bit
@@ -1077,8 +2043,14 @@ def raw2nc(record, datapos, fname_in, fname_out):
 
             fname_out (string):
                 file name of the output netcdf file.  Cannot be the
-                same as fname_in
+                same as fname_in.  The file is written under a temporary
+                name and only renamed to fname_out once it is complete
 
+            chunk_records (int):
+                number of records converted at a time
+
+        Output:
+            number of records converted
     """
     assert fname_in != fname_out, "Cannot overwrite file"
 
@@ -1089,41 +2061,114 @@ def raw2nc(record, datapos, fname_in, fname_out):
 
     if s % size:
         raise RuntimeError("Bad size from {} for {}.  Sizes: {} and {}, leaves {} unused bits".format(record, fname_in, s, size, s % size))
+    if not s:
+        raise RuntimeError("No data in {}".format(fname_in))
+
+    # Map the file as 32bit words, the first of each record is the time
+    n = s // size
+    endian = '>' if record[0] == '>' else '<' if record[0] == '<' else '='
+    raws = np.memmap(fname_in, dtype=endian+'f4', mode='r', shape=(n, size//4))
+    times = raws[:, 0].view(endian+'i4')
+    raws = raws[:, 1:]
+
+    def chunks():
+        for i0 in range(0, n, chunk_records):
+            i1 = min(i0 + chunk_records, n)
+            data = {"time": np.reshape(np.float64(times[i0:i1]), (i1-i0, 1))}
+            for key in datapos:
+                if key == 'time':
+                    pass
+                else:
+                    data[key] = np.array(raws[i0:i1, datapos[key][0]:datapos[key][1]], np.float32)
+            yield data
 
-    raws = []
-    times = []
-    nbits = 0
-    with open(fname_in, 'rb') as file:
-        while True and s > 0:
-            try:
-                times.append(np.frombuffer(file.read(4), '>i4' if record[0] == '>' else 'i4')[0])
-                raws.append(np.float32(np.frombuffer(file.read(size-4), '>f4' if record[0] == '>' else 'f4')))
-                nbits += size
-                if nbits >= s:
-                    break
-            except:
-                raise RuntimeError("Error in reading file. Wrong bitcount")
+    part = os.path.join(os.path.dirname(fname_out),
+                        '.' + os.path.basename(fname_out) + '.part')
+    try:
+        raw_nc(part, n).save_chunks(chunks(), fname_in)
+        os.replace(part, fname_out)
+    finally:
+        for fname in (part, part + '.lock'):
+            if os.path.exists(fname):
+                os.remove(fname)
+    return n
 
-    fout = raw_nc(fname_out, len(times))
 
-    data = {"time": np.reshape(np.float64(times), (len(times), 1))}
-    raws = np.stack(raws, axis=0)
+def raw2nc_dir(record, datapos, dir_in, dir_out, ext='.raw', workers=4,
+               chunk_records=1024):
+    """ Converts all raw files of a directory to netcdf files
 
-    for key in datapos:
-        if key == 'time':
-            pass
+        The files are converted by raw2nc in a pool of processes.
+        Output files that already exist are skipped.  A summary of
+        the conversion is printed at the end.
+
+        Input:
+            record (string):
+                as for raw2nc
+
+            datapos (dict):
+                as for raw2nc
+
+            dir_in (string):
+                directory of the raw files
+
+            dir_out (string):
+                directory of the netcdf files, named as the raw files
+                but with ".nc" instead of ext, created if missing
+
+            ext (string):
+                extension of the raw files
+
+            workers (int):
+                number of processes
+
+            chunk_records (int):
+                as for raw2nc
+
+        Output:
+            dict of the number of records converted for each input file,
+            or the error if the conversion failed
+    """
+    os.makedirs(dir_out, exist_ok=True)
+
+    jobs = []
+    skipped = 0
+    for fname in sorted(os.listdir(dir_in)):
+        if not fname.endswith(ext):
+            continue
+        fname_out = os.path.join(dir_out, fname[:-len(ext)] + '.nc')
+        if os.path.exists(fname_out):
+            skipped += 1
         else:
-            data[key] = np.array(raws[:, datapos[key][0]:datapos[key][1]], np.float32)
+            jobs.append((os.path.join(dir_in, fname), fname_out))
+
+    out = {}
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(raw2nc, record, datapos, fname_in, fname_out,
+                               chunk_records) for fname_in, fname_out in jobs]
+        for (fname_in, fname_out), future in zip(jobs, futures):
+            try:
+                out[fname_in] = future.result()
+            except Exception as e:
+                print("Failed to convert {}: {}".format(fname_in, e))
+                out[fname_in] = e
 
-    fout.save_full(data, fname_in)
+    dt = max(time.time() - t0, 1e-9)
+    done = [x for x in out.values() if not isinstance(x, Exception)]
+    n = sum(done)
+    print("converted {} files, {} records in {:.1f} s ({:.1f} records/s), "
+          "skipped {} existing, {} failed".format(
+                  len(done), n, dt, n / dt, skipped, len(out) - len(done)))
+    return out
 
 
-def nc2raw(datapos, fname_in, fname_out):
+def nc2raw(datapos, fname_in, fname_out, block_records=1024):
     """ Takes a netcdf file and writes a standard raw-form file
 
-        Creates a buffer for every 'records' in the input netcdf
-        file.  This buffer is printed with each variable in big
-        endian mode to the output raw-form file.
+        Creates a big endian buffer for a block of 'records' in the
+        input netcdf file, with each variable in the order of datapos.
+        This buffer is written to the output raw-form file.
 
         Input:
             datapos (list):
@@ -1140,33 +2185,38 @@ def nc2raw(datapos, fname_in, fname_out):
             fname_out (string):
                 Filename of the output raw-form file.  Cannot be same
                 as fname_in
+
+            block_records (int):
+                Number of records read and written at a time
     """
     assert fname_in != fname_out, "Cannot overwrite file"
 
-    endianness_map = {
-    '>': 'big',
-    '<': 'little',
-    '=': sys.byteorder,
-    '|': 'not applicable',
-    }
-
     f = nc.Dataset(fname_in, "r")
-    a = open(fname_out, "wb")
+    f.set_auto_mask(False)
+
+    # Big endian record with the zeroes as their own fields
+    dtype = [('time', '>i4')]
+    for i, x in enumerate(datapos):
+        if isinstance(x, str):
+            if x == 'time':
+                continue
+            var = f.variables[x]
+            dtype.append((x, '>' + var.dtype.str[1:],
+                          (int(np.prod(var.shape[1:])), )))
+        else:
+            dtype.append(('zeros' + str(i), '>i4', (int(x), )))
+    dtype = np.dtype(dtype)
 
     n = f.variables['time'].shape[0]
-    for i in range(n):
-        buffer = np.array([int(f.variables['time'][i, 0])], '>i4').tobytes()
-        for x in datapos:
-           if isinstance(x, str):
-               if x == 'time':
-                   continue
-               var = f.variables[x][i, :].flatten()
-               if endianness_map[var.dtype.byteorder] == 'little':
-                   var = var.byteswap()
-               buffer += var.tobytes()
-           else:
-               buffer += np.zeros((int(x)), '>i4').tobytes()
-        a.write(buffer)
-
-    a.close()
+    buffer = np.zeros(min(block_records, n), dtype=dtype)
+    with open(fname_out, "wb") as a:
+        for i0 in range(0, n, block_records):
+            i1 = min(i0 + block_records, n)
+            block = buffer[:i1-i0]
+            block['time'] = f.variables['time'][i0:i1, 0]
+            for x in datapos:
+                if isinstance(x, str) and x != 'time':
+                    block[x] = f.variables[x][i0:i1].reshape(i1-i0, -1)
+            block.tofile(a)
+
     f.close()
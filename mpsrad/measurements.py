@@ -59,8 +59,10 @@ class measurements:
 #		spectrometer_tcp_ports=[1788, 25144],
 		spectrometer_udp_ports=[None, None, 16210],
 #		spectrometer_udp_ports=[None, 16210],
-		spectrometer_reversing=[True, True, False]):
-#		spectrometer_reversing=[True, False]):
+		spectrometer_reversing=[True, True, False],
+#		spectrometer_reversing=[True, False],
+		keep_files_open=False, buffer_cycles=0, write_thread=False,
+		queue_records=64):
 
 		""" Initialize the machine
 
@@ -117,6 +119,20 @@ class measurements:
 				list of tcp port
 			spectrometer_udp_ports (list):
 				list of udp ports
+			keep_files_open (boolean):
+				Keep the output files open between records, see files.raw_nc.
+				Other processes can only read the open files if this one
+				runs with HDF5_USE_FILE_LOCKING=FALSE in its environment
+			buffer_cycles (int):
+				Chopper cycles to collect in memory before saving them
+				to the output files, see files.raw_nc_buffer, 0 to save
+				every record as it is measured
+			write_thread (boolean):
+				Save to every output file in a thread of its own, so
+				that the measurements only wait for the disk when the
+				queue of the file is full, see files.raw_nc_thread
+			queue_records (int):
+				Size of the queue of each output file with write_thread
 		"""
 		assert not (full_file % 4), "Must have full series in file"
 		assert wait >= 0.0, "Cannot have negative waiting time"
@@ -185,6 +201,12 @@ class measurements:
 		self._formatnames=formatnames
 		self._if=float(if_offset)
 		self._integration_time=float(integration_time)
+		self._keep_files_open=keep_files_open
+		self._buffer_cycles=buffer_cycles
+		self._write_thread=write_thread
+		self._queue_records=queue_records
+		self._files=[]
+		self._closing=[]
 
 		# Counter
 		self._i=0
@@ -456,11 +478,17 @@ class measurements:
 		assert self._initialized, ("Cannot set files of uninitialized "
 			"measurement series")
 		try:
-			self._files=[]
+			self.close_files(wait=False)
 			t=datetime.datetime.now().isoformat().split('.')[0]
 			for i in range(self._spectrometers_count):
-				self._files.append(files.raw_nc(self._basename+self._formatnames[i] +
-								t+'.'+str(i)+'.nc', self._full_file))
+				f=files.raw_nc(self._basename+self._formatnames[i] +
+								t+'.'+str(i)+'.nc', self._full_file,
+								keep_open=self._keep_files_open)
+				if self._buffer_cycles:
+					f=files.raw_nc_buffer(f, self._buffer_cycles, len(self.order))
+				if self._write_thread:
+					f=files.raw_nc_thread(f, self._queue_records)
+				self._files.append(f)
 
 			for f in self._files:
 				print("Printing {} records to {}".format(self._full_file, f.filename))
@@ -505,9 +533,41 @@ class measurements:
 	def save(self):
 		pass
 
+	def close_files(self, wait=True):
+		"""Closes the output files
+
+		Parameters:
+			wait (bool):
+				Wait for the write threads to close their files.  Without
+				wait, at a rollover, the threads close them in the
+				background and are waited for at the next call once done
+		"""
+		if self._write_thread:
+			for f in self._files:
+				f.close(wait=False)
+			self._closing+=self._files
+		else:
+			for f in self._files:
+				f.close()
+		self._files=[]
+
+		for f in list(self._closing):
+			if not wait and not f.done():
+				continue
+			self._closing.remove(f)
+			f.close()
+			print("Saved {records} records to {0}, queue depth at most "
+				"{max_depth}, latency at most {max_latency:.3f} s, "
+				"{full} saves waited".format(f.filename, **f.stats()))
+
 	def close(self):
 		"""Tries to close all devices upon error with any of them...
 		"""
+		try:
+			self.close_files()
+			print('Closed output files')
+		except:
+			pass
 		ndevices=5+len(self.spec)
 		n=0
 		try:
@@ -8,9 +8,19 @@ Created on Tue Sep 17 08:16:15 2019
 
 
 import os
+import re
+import time
+import json
+import hashlib
 import datetime
+import traceback
 import netCDF4 as nc
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
 from mpsrad.files import raw_nc
 
 
@@ -45,27 +55,177 @@ def calibrate(self, pc, ph, pm, tc, th, noise=False):
 
 
 class trp_corr:
-    def __init__(self, trp_target, trp_temp=273.15, method="median"):
+    """ Tropospheric correction of calibrated spectra
+
+        The spectra are corrected by the pseudo-transmission that takes
+        their reference brightness temperature to trp_target for a
+        troposphere of trp_temp.  The reference temperature is found by
+        method:
+            "median": the median of the spectrum
+
+            "edges": the mean of the edge fraction of the channels at
+            either end of the spectrum
+
+        Other methods plug in as a method level_<name> returning the
+        reference temperatures of spectra of shape (..., channels)
+
+        Input:
+            trp_target: brightness temperature to correct to
+
+            trp_temp: temperature of the troposphere
+
+            method: way of finding the reference temperature
+
+            edge: fraction of the channels at each end for "edges"
+    """
+    def __init__(self, trp_target, trp_temp=273.15, method="median", edge=0.1):
         self.target = trp_target
         self.T0 = trp_temp
         self.method = method
+        self.edge = edge
 
     def __call__(self, spec):
-        if self.method == "median":
-            return self.by_median(spec)
-        else:
-            assert False, "Cannot understand method"
+        """ Returns the corrected spectra, reference temperatures and
+        pseudo-transmissions of spec, of shape (..., channels)
 
-    def by_median(self, spec):
-        spec0 = np.median(spec)
+        Spectra without a finite reference temperature or transmission
+        are returned as they are, with -1 as both
+        """
+        level = getattr(self, 'level_' + self.method, None)
+        assert level is not None, "Cannot understand method"
+
+        spec = np.asarray(spec)
+        return self.correct(spec, level(spec))
+
+    def correct(self, spec, spec0):
+        """ Returns spec corrected to have spec0 at the target, see __call__ """
         div = self.T0 - self.target
 
-        pt = np.exp(- np.log((self.T0 - spec0) / div))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            pt = np.exp(- np.log((self.T0 - spec0) / div))
+            ok = np.isfinite(pt) & np.isfinite(spec0)
+            out = np.where(ok[..., None],
+                           spec * pt[..., None] + self.T0 * (1.0 - pt[..., None]),
+                           spec)
+        return out, np.where(ok, spec0, -1)[()], np.where(ok, pt, -1)[()]
+
+    def by_median(self, spec):
+        spec = np.asarray(spec)
+        return self.correct(spec, self.level_median(spec))
+
+    def level_median(self, spec):
+        return np.median(spec, axis=-1)
+
+    def level_edges(self, spec):
+        k = max(1, int(self.edge * spec.shape[-1]))
+        return np.mean(np.concatenate((spec[..., :k], spec[..., -k:]), axis=-1), axis=-1)
+
+
+class bin_plan:
+    """Plan of the binning of data on a frequency grid
+
+    The bins are single channels within 5*steps channels of the line
+    center, and further out bins of 2, 4, 8, ... channels, doubling
+    every steps bins.  The plan is made once per grid and applied to
+    any number of spectra.  It keeps the first channel and the number
+    of channels of every bin, and the binned freq vector f.
+
+    Input:
+        f: freq vector
+
+        f0: line center
+
+        steps: number of steps before doubling step-size
+    """
+    def __init__(self, f, f0, steps=6):
+        n = len(f)
+        self.n = n
 
-        if not np.isnan(pt) and not np.isinf(pt) and not np.isnan(spec0) and not np.isinf(spec0):
-            return spec * pt + self.T0 * (1.0 - pt), spec0, pt
+        if f0 in f:
+            f0bin = np.where(f == f0)[0][0]
         else:
-            return spec, -1, -1
+            less = f < f0
+            more = f > f0
+            if any(less) and any(more):
+                f0bin = np.where(more)[0][0]
+            elif any(less):
+                f0bin = n
+            else:
+                f0bin = 0
+
+        center = [True]
+        fbin = [f0bin+5*steps]
+        dn = 2
+        while fbin[-1] < n:
+            i = 0
+            while i < steps and fbin[-1] < n:
+                i += 1
+                fbin.append(fbin[-1] + dn)
+                center.append(False)
+            dn *= 2
+        fbin[-1] = n
+
+        center.append(True)
+        fbin.append(f0bin-5*steps)
+        dn = -2
+        while fbin[-1] > 0:
+            i = 0
+            while i < steps and fbin[-1] > 0:
+                i += 1
+                fbin.append(fbin[-1] + dn)
+                center.append(False)
+            dn *= 2
+        fbin[-1] = 0
+
+        INDS = np.argsort(fbin)
+        fbin = np.array(fbin, dtype=int)[INDS]
+        center = np.array(center, dtype=bool)[INDS]
+
+        # Channels between two center edges are bins of their own
+        start = []
+        stop = []
+        for i in range(1, len(fbin)):
+            if (center[i] == center[i-1]) and center[i]:
+                start.extend(range(fbin[i-1], fbin[i]))
+                stop.extend(range(fbin[i-1] + 1, fbin[i] + 1))
+            else:
+                start.append(fbin[i-1])
+                stop.append(fbin[i])
+        self.start = np.array(start, dtype=int)
+        self.count = np.array(stop, dtype=int) - self.start
+
+        fred = self._bin(np.asarray(f))
+        self.order = np.argsort(fred)
+        self.f = fred[self.order]
+
+    def apply(self, x):
+        """Returns the binned data
+
+        Input:
+            x: data of shape (..., channels)
+
+        Output:
+            binned data of shape (..., bins), NaN for bins without
+            channels
+        """
+        x = np.asarray(x)
+        assert x.shape[-1] == self.n, "Mismatch data to frequency grid"
+        return self._bin(x)[..., self.order]
+
+    def _bin(self, x):
+        """Returns the means of the bins, in order of channels
+
+        Every bin is summed over all the spectra at once, as a mean
+        of its own so that the sums are pairwise as in np.mean
+        """
+        out = np.full(x.shape[:-1] + (len(self.start), ), np.nan,
+                      dtype=x.dtype if x.dtype.kind == 'f' else float)
+
+        single = self.count == 1
+        out[..., single] = x[..., self.start[single]]
+        for i in np.flatnonzero(self.count > 1):
+            out[..., i] = np.mean(x[..., self.start[i]:self.start[i] + self.count[i]], axis=-1)
+        return out
 
 
 def bindata(x, f, f0, steps=6, do_x=True):
@@ -87,70 +247,12 @@ def bindata(x, f, f0, steps=6, do_x=True):
 
         fbin: Binned freq vector
     """
-    n = len(f)
-    if do_x:
-        assert n == len(x)
-
-    if f0 in f:
-        f0bin = np.where(f == f0)[0][0]
-    else:
-        less = f < f0
-        more = f > f0
-        if any(less) and any(more):
-            f0bin = np.where(more)[0][0]
-        elif any(less):
-            f0bin = n
-        else:
-            f0bin = 0
-
-    center = [True]
-    fbin = [f0bin+5*steps]
-    dn = 2
-    while fbin[-1] < n:
-        i = 0
-        while i < steps and fbin[-1] < n:
-            i += 1
-            fbin.append(fbin[-1] + dn)
-            center.append(False)
-        dn *= 2
-    fbin[-1] = n
-
-    center.append(True)
-    fbin.append(f0bin-5*steps)
-    dn = -2
-    while fbin[-1] > 0:
-        i = 0
-        while i < steps and fbin[-1] > 0:
-            i += 1
-            fbin.append(fbin[-1] + dn)
-            center.append(False)
-        dn *= 2
-    fbin[-1] = 0
-
-    INDS = np.argsort(fbin)
-    fbin = np.array(fbin, dtype=int)[INDS]
-    center = np.array(center, dtype=bool)[INDS]
-
-    xred = []
-    fred = []
-    for i in range(1, len(fbin)):
-        if (center[i] == center[i-1]) and center[i]:
-            for j in range(fbin[i-1], fbin[i]):
-                fred.append(f[j])
-                if do_x:
-                    xred.append(x[j])
-        else:
-            fred.append(f[fbin[i-1]:fbin[i]].mean())
-            if do_x:
-                xred.append(x[fbin[i-1]:fbin[i]].mean())
-    fred = np.array(fred)
-    xred = np.array(xred)
-    INDS = np.argsort(fred)
-
+    plan = bin_plan(f, f0, steps)
     if do_x:
-        return xred[INDS], fred[INDS]
+        assert len(f) == len(x)
+        return plan.apply(x), plan.f
     else:
-        return fred[INDS]
+        return plan.f
 
 
 class clb_nc:
@@ -244,89 +346,218 @@ class clb_nc:
 
         return th
 
-    def save_full_clb(self, clbfile):
+    def cycles(self, k0, k1, channels=slice(None), cold=0., hot=0.):
+        """ Returns the calibration of the measurements k0 to k1
+
+        Measurement k is the [A] of the C[A]H[A] cycle of raw record
+        ind = 2*k + 1, calibrated with the loads pc, ph, pm, tc and th
+        select for ind.  The raw records of all the measurements are
+        read at once and calibrated as one array
+
+        Input:
+            k0: first measurement
+
+            k1: measurement after the last
+
+            channels: slice of the channels to calibrate
+
+            cold: added to the cold load temperature
+
+            hot: added to the hot load temperature
+
+        Output:
+            dict of pc, ph and pm of shape (k1-k0, spectras, channels),
+            tc and th of shape (k1-k0, 1, 1), cal the calibrated pm, and
+            the other raw variables at the measurements
+        """
+        r = slice(2*k0, 2*k1 + 1)
+        ind = 2*np.arange(k0, k1) + 1
+        first = ind % 4 == 1
+        ic = np.where(first, ind-1, ind+1) - r.start
+        ih = np.where(first, ind+1, ind-1) - r.start
+        im = ind - r.start
+
+        record = np.array(self.rawfile.get_variable("record", r))[:, :, channels]
+        tc = np.array(self.rawfile.get_variable("cold_load", r, 0))[ic]
+        th = np.array(self.rawfile.get_variable("hot_load", r, 0))[ih]
+        if self.rawfile.has_attribute('cold_load_offset'):
+            tc += self.rawfile.get_attribute('cold_load_offset')
+        if self.rawfile.has_attribute('hot_load_offset'):
+            th += self.rawfile.get_attribute('hot_load_offset')
+
+        out = {'pc': record[ic], 'ph': record[ih], 'pm': record[im],
+               'tc': tc.reshape(-1, 1, 1) + cold,
+               'th': th.reshape(-1, 1, 1) + hot}
+        out['cal'] = calibrate(self, out['pc'], out['ph'], out['pm'],
+                               out['tc'], out['th'], noise=False)
+
+        for var in self.rawfile.variables():
+            if var != 'record':
+                out[var] = np.array(self.rawfile.get_variable(var, r))[im]
+        return out
+
+    def save_full_clb(self, clbfile, block_cycles=64):
         """ Saves the calibration to a new calibrated file
 
             If there is a nextrawfile given, it is used to
             append a final value to the measurement for the
             overlap time
+
+            block_cycles measurements are calibrated at a time,
+            see cycles
         """
         assert self.rawfile.filename != clbfile, "Bad filenames"
-        data = nc.Dataset(clbfile, 'w')
+        with self.rawfile.session():
+            data = nc.Dataset(clbfile, 'w')
 
-        n = self.rawfile.get_pos()
-        if n + 1 == self.rawfile.get_dimension('records'):
-            data.createDimension("records", self.rawfile.get_dimension('records')//2 - 1)
-        else:
-            data.createDimension("records", n//2 - 1)
+            n = self.rawfile.get_pos()
+            if n + 1 == self.rawfile.get_dimension('records'):
+                data.createDimension("records", self.rawfile.get_dimension('records')//2 - 1)
+            else:
+                data.createDimension("records", n//2 - 1)
 
-        # Add all old dimensions
-        for dim in self.rawfile.dimensions():
-            if dim != "records":
-                data.createDimension(dim, self.rawfile.get_dimension(dim))
+            # Add all old dimensions
+            for dim in self.rawfile.dimensions():
+                if dim != "records":
+                    data.createDimension(dim, self.rawfile.get_dimension(dim))
 
-        # Add all old variables
-        output = {}
-        for var in self.rawfile.variables():
-            typs = self.rawfile.variable_dtype(var)
-            dims = self.rawfile.variable_dimensions(var)
-            data.createVariable(var, typs, dims)
+            # Add all old variables
+            output = {}
+            for var in self.rawfile.variables():
+                typs = self.rawfile.variable_dtype(var)
+                dims = self.rawfile.variable_dimensions(var)
+                data.createVariable(var, typs, dims)
 
-            output[var] = []
+                output[var] = []
 
-        # Generate data
-        for k in range(data.dimensions['records'].size):
-            ind = 2*k + 1  # C[A]H[A], selecting A gives every 2k+1 variable is important
-            pc = self.pc(ind)
-            ph = self.ph(ind)
-            pm = self.pm(ind)
-            th = self.th(ind)
-            tc = self.tc(ind)
-            cal = calibrate(self, pc, ph, pm, tc, th, noise=False)
+            # Generate data
+            records = data.dimensions['records'].size
+            for k0 in range(0, records, block_cycles):
+                x = self.cycles(k0, min(k0 + block_cycles, records))
 
-            if cal is None:
-                raise RuntimeError("Bad netcdf conversion")
+                # for all variables but record, keep a copy
+                for var in self.rawfile.variables():
+                    if var == 'record':
+                        output[var].append(x['cal'])
+                    else:
+                        output[var].append(x[var])
 
-            # for all variables but record, keep a copy
+            # Write variables to file
             for var in self.rawfile.variables():
-                if var == 'record':
-                    output[var].append(cal)
-                else:
-                    output[var].append(self.measurement_variable(var, ind))
+                data.variables[var][:] = np.concatenate(output[var])
+
+            # Set the standard attributes
+            data.version = self.version
+            data.source = self.rawfile.get_attribute('source') if self.rawfile.has_attribute('source') else "UNDEFINED"
+            data.end_time = self.rawfile.get_attribute('end_time') if self.rawfile.has_attribute('end_time') else "UNDEFINED"
+            data.start_time = self.rawfile.get_attribute('start_time') if self.rawfile.has_attribute('start_time') else "UNDEFINED"
+            data.hot_load_offset = self.rawfile.get_attribute('hot_load_offset') if self.rawfile.has_attribute('hot_load_offset') else 0.0
+            data.cold_load_offset = self.rawfile.get_attribute('cold_load_offset') if self.rawfile.has_attribute('cold_load_offset') else 0.0
+
+            data.close()
+
+    def save_full_red(self, redfile, tropospheric_correction, reduction_method,
+                      block_cycles=64, resume=False):
+        """ Saves the calibration to a new reduced file
+
+            block_cycles measurements are calibrated and written to
+            the file at a time, see cycles.  The "pos" attribute of the
+            file is the last record written and the file is synced after
+            every block.
+
+            If resume is True and redfile is a partial reduced file of
+            the same raw file, records and reduction, i.e., frequency
+            grids, channels, load offsets and tropospheric correction, it
+            is completed from the record after its "pos" instead of being
+            written anew
+
+            Returns the number of records of the reduced file
+        """
+        assert self.rawfile.filename != redfile, "Bad filenames"
+        with self.rawfile.session():
 
-        # Write variables to file
-        for var in self.rawfile.variables():
-            data.variables[var][:] = np.array(output[var])
+            start_ind = reduction_method.get('start_ind', 0)
+            end_ind = reduction_method.get('end_ind', -1)
 
-        # Set the standard attributes
-        data.version = self.version
-        data.source = self.rawfile.get_attribute('source') if self.rawfile.has_attribute('source') else "UNDEFINED"
-        data.end_time = self.rawfile.get_attribute('end_time') if self.rawfile.has_attribute('end_time') else "UNDEFINED"
-        data.start_time = self.rawfile.get_attribute('start_time') if self.rawfile.has_attribute('start_time') else "UNDEFINED"
-        data.hot_load_offset = self.rawfile.get_attribute('hot_load_offset') if self.rawfile.has_attribute('hot_load_offset') else 0.0
-        data.cold_load_offset = self.rawfile.get_attribute('cold_load_offset') if self.rawfile.has_attribute('cold_load_offset') else 0.0
+            # Reduced frequencies
+            f_orig = reduction_method['freq']
+            assert len(f_orig) == self.rawfile.get_dimension('channels'), "Mismatch frequency grid to channels grid"
+            plan = bin_plan(f_orig[start_ind:end_ind], reduction_method['freq0'], reduction_method['steps'])
+            f_red = plan.f
 
-        data.close()
+            n = self.rawfile.get_pos()
+            if n + 1 == self.rawfile.get_dimension('records'):
+                records = self.rawfile.get_dimension('records')//2 - 1
+            else:
+                records = n//2
+
+            # Settings of the reduction not in the frequency grids
+            trp = tropospheric_correction
+            settings = json.dumps({
+                'start_ind': start_ind, 'end_ind': end_ind,
+                'cold': np.asarray(reduction_method.get('cold', 0.), dtype=float).tolist(),
+                'hot': np.asarray(reduction_method.get('hot', 0.), dtype=float).tolist(),
+                'trp': {key: getattr(trp, key, None)
+                        for key in ('target', 'T0', 'method', 'edge')}},
+                sort_keys=True, default=str)
+
+            data = self._open_red(redfile, records, f_orig, f_red, settings) \
+                if resume else None
+            if data is None:
+                data = self._create_red(redfile, records, f_orig, f_red, settings)
 
-    def save_full_red(self, redfile, tropospheric_correction, reduction_method):
-        """ Saves the calibration to a new reduced file """
-        assert self.rawfile.filename != redfile, "Bad filenames"
+            try:
+                # Generate data
+                for k0 in range(data.pos + 1 if 'pos' in data.ncattrs() else 0,
+                                records, block_cycles):
+                    print('{}% DONE'.format(round(100*k0/records, 1)))
+
+                    k1 = min(k0 + block_cycles, records)
+                    x = self.cycles(k0, k1, slice(start_ind, end_ind),
+                                    reduction_method.get('cold', 0.),
+                                    reduction_method.get('hot', 0.))
+                    m = k1 - k0
+
+                    cal = x['cal']
+                    for k in np.flatnonzero(~np.isfinite(cal).all(axis=(1, 2))):
+                        bads, xi = bad_val_helper(cal[k])
+                        cal[k][bads]= np.interp(xi(bads), xi(~bads), cal[k][~bads])
+
+                    output = {"mean_cold_count": np.mean(x['pc'], axis=2),
+                              "mean_hot_count": np.mean(x['ph'], axis=2),
+                              "mean_atm_count": np.mean(x['pm'], axis=2),
+                              "mean_cold_temp": x['tc'],
+                              "mean_hot_temp": x['th']}
+
+                    # for all variables but record, keep a copy
+                    for var in self.rawfile.variables():
+                        if var == 'record':
+                            c, cal0, pt = tropospheric_correction(cal)
+                            output[var] = plan.apply(c)
+                            output["pseudo_transmission"] = pt
+                            output["median"] = cal0
+                        else:
+                            output[var] = x[var]
+
+                    # Write the block to file
+                    for var in output:
+                        v = data.variables[var]
+                        v[k0:k1] = np.reshape(output[var], (m, ) + v.shape[1:])
+                    data.pos = k1 - 1
+                    data.sync()
+            finally:
+                data.close()
 
-        start_ind = reduction_method.get('start_ind', 0)
-        end_ind = reduction_method.get('end_ind', -1)
+            return records
 
-        # Reduced frequencies
-        f_orig = reduction_method['freq']
-        assert len(f_orig) == self.rawfile.get_dimension('channels'), "Mismatch frequency grid to channels grid"
-        f_red = bindata(None, f_orig[start_ind:end_ind], reduction_method['freq0'], reduction_method['steps'], do_x=False)
+    def _create_red(self, redfile, records, f_orig, f_red, settings):
+        """ Returns a new reduced file of records without any written
 
+            settings is kept as the "reduction" attribute
+        """
         data = nc.Dataset(redfile, 'w')
 
-        n = self.rawfile.get_pos()
-        if n + 1 == self.rawfile.get_dimension('records'):
-            data.createDimension("records", self.rawfile.get_dimension('records')//2 - 1)
-        else:
-            data.createDimension("records", n//2)
+        data.createDimension("records", records)
 
         # Add all old dimensions
         for dim in self.rawfile.dimensions():
@@ -337,84 +568,27 @@ class clb_nc:
         data.createDimension("reduced_channels", len(f_red))
 
         # Add all old variables
-        output = {}
         for var in self.rawfile.variables():
             typs = self.rawfile.variable_dtype(var)
             dims = self.rawfile.variable_dimensions(var)
             if var == 'record':
                 data.createVariable("f_orig", f_orig.dtype, ("channels"))
-                output['f_orig'] = f_orig
+                data.variables['f_orig'][:] = f_orig
 
                 data.createVariable("f_red", f_red.dtype, ("reduced_channels"))
-                output['f_red'] = f_red
+                data.variables['f_red'][:] = f_red
 
                 data.createVariable("median", typs, ("records", "spectras"))
-                output["median"] = []
-
                 data.createVariable("pseudo_transmission", typs, ("records", "spectras"))
-                output["pseudo_transmission"] = []
-
                 data.createVariable(var, typs, ("records", "spectras", "reduced_channels"))
-                output[var] = []
 
                 data.createVariable("mean_cold_count", typs, ("records", "spectras", "one"))
                 data.createVariable("mean_hot_count", typs, ("records", "spectras", "one"))
                 data.createVariable("mean_atm_count", typs, ("records", "spectras", "one"))
                 data.createVariable("mean_cold_temp", typs, ("records", "one"))
                 data.createVariable("mean_hot_temp", typs, ("records", "one"))
-                output["mean_cold_count"] = []
-                output["mean_hot_count"] = []
-                output["mean_atm_count"] = []
-                output["mean_cold_temp"] = []
-                output["mean_hot_temp"] = []
             else:
                 data.createVariable(var, typs, dims)
-                output[var] = []
-        data.sync()
-
-        # Generate data
-        for k in range(data.dimensions['records'].size):
-            if not k%100:
-                print('{}% DONE'.format(round(100*k/data.dimensions['records'].size, 1)))
-
-            ind = 2*k + 1  # C[A]H[A], selecting A gives every 2k+1 variable is important
-            pc = np.array(self.pc(ind)[:, start_ind:end_ind])
-            ph = np.array(self.ph(ind)[:, start_ind:end_ind])
-            pm = np.array(self.pm(ind)[:, start_ind:end_ind])
-            tc = np.array(self.tc(ind)) + reduction_method.get('cold', 0.)
-            th = np.array(self.th(ind)) + reduction_method.get('hot', 0.)
-            cal = calibrate(self, pc, ph, pm, tc, th, noise=False)
-            bads, x = bad_val_helper(cal)
-            cal[bads]= np.interp(x(bads), x(~bads), cal[~bads])
-
-            output["mean_cold_count"].append(np.mean(pc, axis=1))
-            output["mean_hot_count"].append(np.mean(ph, axis=1))
-            output["mean_atm_count"].append(np.mean(pm, axis=1))
-            output["mean_cold_temp"].append(tc.flatten())
-            output["mean_hot_temp"].append(th.flatten())
-
-            if cal is None:
-                raise RuntimeError("Bad netcdf conversion")
-
-            # for all variables but record, keep a copy
-            for var in self.rawfile.variables():
-                if var == 'record':
-                    cal0 = np.zeros((self.rawfile.get_dimension("spectras")), dtype="f4")
-                    pt = np.zeros((self.rawfile.get_dimension("spectras")), dtype="f4")
-                    cal_red = np.zeros((self.rawfile.get_dimension("spectras"), len(f_red)), dtype="f4")
-                    for spec in range(self.rawfile.get_dimension("spectras")):
-                        c, pt[spec], cal0[spec] = tropospheric_correction(cal[spec])
-                        cal_red[spec], _ = bindata(c, f_orig[start_ind:end_ind],
-                               reduction_method['freq0'], reduction_method['steps'], do_x=True)
-                    output[var].append(cal_red)
-                    output["pseudo_transmission"].append(pt)
-                    output["median"].append(cal0)
-                else:
-                    output[var].append(self.measurement_variable(var, ind))
-
-        # Write variables to file
-        for var in output:
-            data.variables[var][:] = np.array(output[var])
 
         # Set the standard attributes
         data.version = self.version
@@ -424,9 +598,32 @@ class clb_nc:
         data.hot_load_offset = self.rawfile.get_attribute('hot_load_offset') if self.rawfile.has_attribute('hot_load_offset') else 0.0
         data.cold_load_offset = self.rawfile.get_attribute('cold_load_offset') if self.rawfile.has_attribute('cold_load_offset') else 0.0
         data.orig_filename = self.rawfile.filename
+        data.reduction = settings
 
         data.sync()
-        data.close()
+        return data
+
+    def _open_red(self, redfile, records, f_orig, f_red, settings):
+        """ Returns the partial reduced file to resume, or None if it is
+            not of the raw file, records and reduction
+        """
+        if not os.path.exists(redfile):
+            return None
+
+        try:
+            data = nc.Dataset(redfile, 'a')
+        except OSError:
+            return None
+
+        if getattr(data, 'orig_filename', None) != self.rawfile.filename or \
+                data.dimensions['records'].size != records or \
+                getattr(data, 'reduction', None) != settings or \
+                'f_red' not in data.variables or \
+                not np.array_equal(data.variables['f_orig'][:], f_orig) or \
+                not np.array_equal(data.variables['f_red'][:], f_red):
+            data.close()
+            return None
+        return data
 
 def timegroup(timelist, times):
     for i in range(len(timelist)-1):
@@ -437,77 +634,95 @@ def timegroup(timelist, times):
     return len(timelist)-1
 
 
-def minute(r, min):
+def _times(r):
     try:
-        time = r['TIME'].flatten()
-        n = r.n
+        return np.asarray(r['TIME']).flatten()[:r.n]
     except:
-        time = r
-        n = len(r)
+        return np.asarray(r, dtype=float).flatten()
 
-    t0 = datetime.datetime.fromtimestamp(time[0])
-    start = 0
 
-    minutes = np.linspace(0, 60-min, 60//min)
-    g0 = timegroup(minutes, t0.minute)
+periods = {'s': 's', 'min': 'm', 'h': 'h', 'D': 'D', 'W': 'W'}
+_period = re.compile(r'(\d*)\s*(s|min|h|D|W)')
 
-    inds = [start]
-    for i in range(start, n):
-        t = datetime.datetime.fromtimestamp(time[i])
-        g = timegroup(minutes, t.minute)
+# Local time the periods are counted from, a Monday
+_epoch = np.datetime64('1970-01-05T00:00:00', 's')
 
-        if t0.day != t.day or g != g0:
-            g0 = g
-            t0 = t
-            inds.append(i)
-    return inds
 
+def _period_step(period):
+    """Returns the timedelta64 of a period of time_groups, such as "7D" """
+    m = _period.fullmatch(period)
+    assert m is not None, "Cannot understand period {}".format(period)
+    n = int(m.group(1) or 1)
+    if n <= 0:
+        raise ValueError("Need a period longer than 0, got {}".format(period))
+    return np.timedelta64(n, periods[m.group(2)])
 
-def hour(r, h):
-    try:
-        time = r['TIME'].flatten()
-        n = r.n
-    except:
-        time = r
-        n = len(r)
 
-    t0 = datetime.datetime.fromtimestamp(time[0])
-    start = 0
+def local_time(times, tz=None):
+    """Returns unix times as datetime64[s] of their local time in tz
 
-    hours = np.linspace(0, 24-h, 24//h)
-    g0 = timegroup(hours, t0.hour)
+    Input:
+        times: unix times
 
-    inds = [start]
-    for i in range(start, n):
-        t = datetime.datetime.fromtimestamp(time[i])
-        g = timegroup(hours, t.hour)
+        tz: a tzinfo, the name of a time zone, or None for the time zone
+            of the computer, as datetime.datetime.fromtimestamp
 
-        if t0.day != t.day or g != g0:
-            g0 = g
-            t0 = t
-            inds.append(i)
-    return inds
+    Output:
+        datetime64[s] array of the local times
+    """
+    if isinstance(tz, str):
+        assert ZoneInfo is not None, "Named time zones need zoneinfo"
+        tz = ZoneInfo(tz)
 
+    # The offset from UTC is found once per half hour, when it may change
+    times = np.asarray(times, dtype=float)
+    halves, inv = np.unique(np.floor(times / 1800), return_inverse=True)
+    offset = np.array([datetime.datetime.fromtimestamp(h * 1800, tz).utcoffset().total_seconds()
+                       if tz is not None else time.localtime(h * 1800).tm_gmtoff
+                       for h in halves])
+    return np.floor(times + offset[inv.reshape(times.shape)]).astype('int64').astype('datetime64[s]')
 
-def days(r, days):
-    try:
-        time = r['TIME'].flatten()
-        n = r.n
-    except:
-        time = r
-        n = len(r)
 
-    t0 = datetime.datetime.fromtimestamp(time[0])
-    start = 0
+def time_groups(r, period, tz=None):
+    """Returns the first index of every group of times in a period
 
-    inds = [start]
-    for i in range(start, n):
-        t = datetime.datetime.fromtimestamp(time[i])
+    The local times are floored to the period counted from a fixed
+    Monday midnight, so groups of minutes and hours start at the full
+    minute or hour, groups of days at midnight and groups of weeks on
+    Mondays, and the groups of a time do not depend on the first time.
+    A new group starts where the floored time changes.
 
-        if (days+t0.day) <= t.day:
-            t0 = t
-            inds.append(i)
-    return inds
+    Input:
+        r: unix times, sorted
+
+        period: "<n><unit>" with unit one of s, min, h, D or W, such as
+            "2min", "15min", "1h", "1D" or "7D"
+
+        tz: time zone of the local times, see local_time
+
+    Output:
+        array of the first index of every group, starting with 0
+    """
+    step = _period_step(period)
+
+    t = local_time(_times(r), tz)
+    if not len(t):
+        return np.zeros(0, dtype=int)
+
+    group = (t - _epoch) // step
+    return np.concatenate(([0], np.flatnonzero(np.diff(group)) + 1))
+
+
+def minute(r, min, tz=None):
+    return time_groups(r, '{}min'.format(min), tz)
+
+
+def hour(r, h, tz=None):
+    return time_groups(r, '{}h'.format(h), tz)
+
+
+def days(r, days, tz=None):
+    return time_groups(r, '{}D'.format(days), tz)
 
 
 def minutely(r):
@@ -606,9 +821,84 @@ def weekly(r):
     return days(r, 7)
 
 
+class timescale_plan:
+    """ Groups of records of a list of files, as arrays
+
+        Group i holds the records start[i] to end[i], counted over all
+        the files, which are the records first_index[i] onward of file
+        first_file[i] to the records before last_index[i] of file
+        last_file[i]
+
+        Input:
+            files: the files, in order
+
+            lengths: the number of records of the files
+
+            start: first record of every group
+
+            end: record after the last of every group
+
+            month: "%Y-%m" of the start of every group
+    """
+    def __init__(self, files, lengths, start, end, month):
+        self.files = np.array(files, dtype=str)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths, dtype=int)))
+        self.start = np.asarray(start, dtype=int)
+        self.end = np.asarray(end, dtype=int)
+        self.month = np.asarray(month, dtype=str)
+
+        self.first_file = np.searchsorted(self.offsets, self.start, 'right') - 1
+        self.last_file = np.searchsorted(self.offsets, self.end - 1, 'right') - 1
+        self.first_index = self.start - self.offsets[self.first_file]
+        self.last_index = self.end - self.offsets[self.last_file]
+
+    def __len__(self):
+        return len(self.start)
+
+    def months(self):
+        """ Returns the months of the groups, in order """
+        months, first = np.unique(self.month, return_index=True)
+        return list(months[np.argsort(first)])
+
+    def groups(self, month):
+        """ Returns the index of the groups of a month """
+        return np.flatnonzero(self.month == month)
+
+    def pieces(self, i):
+        """ Returns (file, first, end) of the records of group i in
+        every file it covers
+        """
+        f0, f1 = self.first_file[i], self.last_file[i]
+        return [(self.files[f],
+                 self.first_index[i] if f == f0 else 0,
+                 self.last_index[i] if f == f1 else self.offsets[f+1] - self.offsets[f])
+                for f in range(f0, f1 + 1)]
+
+
 class timescale:
-    def __init__(self, types):
+    """ Groups the times of files by timescales
+
+        Input:
+            types: list of timescales, any of "minute", "two_minutes",
+            "five_minutes", "quarter", "hour", "two_hours" and "day",
+            or periods of time_groups such as "10min" or "7D"
+
+            tz: time zone of the groups and months, see local_time
+
+        Output of calling with a list of files:
+            {timescale: timescale_plan} and the times of all the files
+    """
+    names = {'minute': '1min', 'two_minutes': '2min', 'five_minutes': '5min',
+             'quarter': '15min', 'hour': '1h', 'two_hours': '2h', 'day': '1D'}
+
+    def __init__(self, types, tz=None):
         self.types = types
+        self.tz = tz
+
+    def span(self):
+        """ Returns the seconds of the longest period of the types """
+        return max(int(_period_step(self.names.get(key, key)) /
+                       np.timedelta64(1, 's')) for key in self.types)
 
     def __call__(self, list_of_files):
         times = np.array([])
@@ -625,57 +915,21 @@ class timescale:
             files.append([fil, len(tn)])
             times = np.append(times, tn)
 
-        inds = {}
-        if not files:
-            for key in self.types:
-                inds[key] = {}
-            return inds
+        names = [filedata[0] for filedata in files]
+        lengths = [filedata[1] for filedata in files]
+        local = local_time(times, self.tz)
 
+        plans = {}
         for key in self.types:
-            inds[key] = {}
-
-            if key == 'minute':
-                s = minutely(times)
-            elif key == 'two_minutes':
-                s = two_minutely(times)
-            elif key == 'five_minutes':
-                s = five_minutely(times)
-            elif key == 'quarter':
-                s = fifteen_minutely(times)
-            elif key == 'hour':
-                s = hourly(times)
-            elif key == 'two_hours':
-                s = two_hourly(times)
-            elif key == 'day':
-                s = daily(times)
-            else:
+            period = self.names.get(key, key)
+            if _period.fullmatch(period) is None:
                 raise Warning("Did not find the time-key: {}".format(key))
-                s = None
+            s = time_groups(times, period, self.tz)
 
-            if s is None:
-                continue
-
-            # For all the times
-            for i in range(len(s)-1):
-                month = datetime.datetime.fromtimestamp(times[s[i]]).strftime("%Y-%m")
-                if month not in inds[key]:
-                    inds[key][month] = [[s[i], s[i+1]]]
-                else:
-                    inds[key][month].append([s[i], s[i+1]])
-
-                # Append all the files and append those that fits the time range
-                n = 0
-                for filedata in files:
-                    file = filedata[0]
-                    filelen = filedata[1]
-
-                    if n < s[i] and s[i] <= (n+filelen):
-                        inds[key][month][-1].append(file)
-                    elif n < s[i+1] and s[i+1] <= (n+filelen):
-                        inds[key][month][-1].append(file)
-
-                    n += filelen
-        return inds, times
+            # The last group may go on in files to come
+            month = np.datetime_as_string(local[s[:-1]], unit='M')
+            plans[key] = timescale_plan(names, lengths, s[:-1], s[1:], month)
+        return plans, times
 
 
 def data_by_inds(ncdata, start, end):
@@ -688,71 +942,164 @@ def data_by_inds(ncdata, start, end):
     return s
 
 
-def redfiles2prodir(redfiles, prodir, timescale, std=True):
+class pipeline_manifest:
+    """ Record of the files processed by a step of the processing
+
+        A JSON file with, for every input file processed, its size,
+        modification time, the parameters of the processing and the
+        output made of it.  An input is processed again only if any of
+        those changed or the output is missing.
+
+        Input:
+            filename: the JSON file, made by "save"
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+
+    def changed(self, fname, params):
+        """ Returns True if fname is to be processed with params """
+        entry = self.entries.get(os.path.abspath(fname))
+        if entry is None or not os.path.exists(fname):
+            return True
+
+        stat = os.stat(fname)
+        return entry['size'] != stat.st_size or \
+            entry['mtime'] != stat.st_mtime_ns or \
+            entry['params'] != params or not os.path.exists(entry['output'])
+
+    def record(self, fname, params, output, **info):
+        """ Records that fname is processed with params to output """
+        stat = os.stat(fname)
+        self.entries[os.path.abspath(fname)] = dict(
+            info, size=stat.st_size, mtime=stat.st_mtime_ns, params=params,
+            output=output)
+
+    def save(self):
+        """ Writes the manifest, atomically """
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.filename)
+
+    def months(self, fname, span=86400, tz=None):
+        """ Returns the months, "%Y-%m", of a reduced file
+
+        The months are of the local times in tz, see local_time, as are
+        the months of the groups of a timescale.  The span seconds before
+        the first record are included, as the group of the first record
+        may start there for timescales of periods up to span long
+        """
+        zone = None if tz is None else str(tz)
+        entry = self.entries.get(os.path.abspath(fname))
+        if entry is not None and 'months' in entry and \
+                entry.get('span', 86400) == span and \
+                entry.get('tz') == zone and \
+                entry['size'] == os.stat(fname).st_size and \
+                entry['mtime'] == os.stat(fname).st_mtime_ns:
+            return entry['months']
+
+        with nc.Dataset(fname, 'r') as x:
+            t = np.array(x.variables['time'][:]).flatten()
+        t0, t1 = local_time([t.min() - span, t.max()], tz).astype('datetime64[M]')
+        return [str(m) for m in np.arange(t0, t1 + 1)]
+
+    def affected(self, fnames, params, span=86400, tz=None):
+        """ Returns the months of the files changed, see changed, and
+        the files needed to make them again
+
+        span is the seconds of the longest period of the timescales and
+        tz their time zone, see months
+        """
+        fnames = sorted(fnames)
+        months = {fname: set(self.months(fname, span, tz)) for fname in fnames}
+        todo = set()
+        for fname in fnames:
+            if self.changed(fname, params):
+                todo |= months[fname]
+
+        # Every file of a month is needed to make it again, and makes
+        # all its other months again too
+        while True:
+            files = [fname for fname in fnames if months[fname] & todo]
+            more = set().union(*[months[fname] for fname in files]) - todo
+            if not more:
+                break
+            todo |= more
+
+        # The file after the last one ends the last group of the months
+        if files and files[-1] != fnames[-1]:
+            files.append(fnames[fnames.index(files[-1]) + 1])
+        return files, todo
+
+
+def redfiles2prodir(redfiles, prodir, timescale, std=True, manifest=False,
+                    months=None):
+    """ Averages reduced files to monthly profile files in prodir
+
+        With manifest, the reduced files are recorded in the manifest
+        ".manifest.json" of prodir, and only the months of the files
+        that are new or changed since they were recorded are made
+        again, from all the files of those months
+
+        Only the profiles of the months in months are made if it is
+        not None, also with manifest, when the files of the other months
+        made again are left to be made by a later call
+    """
+    if manifest:
+        record = pipeline_manifest(os.path.join(prodir, '.manifest.json'))
+        params = {'types': list(timescale.types), 'std': bool(std)}
+        if timescale.tz is not None:
+            params['tz'] = str(timescale.tz)
+        span = timescale.span()
+        redfiles, todo = record.affected(redfiles, params, span, timescale.tz)
+        months = todo if months is None else todo & set(months)
+        if not months:
+            return
+
     redfiles.sort()
     # Represent when and how in a file that a timescale is encountered from a list of files, will start from full timescale
-    inds, times = timescale(redfiles)
-    #  Here:
-    #  inds = {TIMESCALE_1: {
-    #              PROFILE_1: [[START_IND, END_IND, FILE1, FILE2, ...], [START_IND, END_IND, FILE1, FILE2, ...], ...],
-    #              PROFILE_2: [[START_IND, END_IND, FILE1, FILE2, ...], [START_IND, END_IND, FILE1, FILE2, ...], ...],
-    #              ...... },
-    #          TIMESCALE_2: {
-    #              PROFILE_1: [[START_IND, END_IND, FILE1, FILE2, ...], [START_IND, END_IND, FILE1, FILE2, ...], ...],
-    #              PROFILE_2: [[START_IND, END_IND, FILE1, FILE2, ...], [START_IND, END_IND, FILE1, FILE2, ...], ...],
-    #              ...... },
-    #          ...... }
-    # where each "TIMESCALE_X" is a timescale and "PROFILE_X" is a monthly name.
-    # The list of each "PROFILE_X" is a list of files that combines to a single
-    # entry in the saved profile.
-
+    plans, times = timescale(redfiles)
+    #  Here plans = {TIMESCALE: timescale_plan}, where every group of
+    #  records of a timescale_plan, by month, combines to a single entry
+    #  in the saved profile of that month, and "pieces" gives the files
+    #  and records of a group.
 
     x = nc.Dataset(redfiles[0], 'r')
     source = x.source
     x.close()
 
     version = None
-    for scale in inds:
-        n = 0
-        ts = inds[scale]
+    for scale in plans:
+        plan = plans[scale]
+
+        for profile in plan.months():
+            if months is not None and profile not in months:
+                continue
 
-        for profile in ts:
             profilename = "{}/pro.{}-{}-{}.nc".format(prodir, source.replace(' ', '-'), profile, scale)
             save_file = nc.Dataset(profilename, 'w')
 
-            prolist = ts[profile]
-
-            fnames = []
+            prolist = plan.groups(profile)
 
+            opened = {}
             for i in range(len(prolist)):
 #                print(profile, ' ', 100*i/len(prolist), '%', sep='')
-                entrylist = prolist[i]
-                start = entrylist[0]
-                end = entrylist[1]
-
-                if len(entrylist) == 3:
-#                    print(start-n, end-n)
-                    redfile = nc.Dataset(entrylist[2], 'r')
-                    avg = data_by_inds(redfile, start-n, end-n)
-                else:
-                    for fileind in range(2, len(entrylist)):
-                        fname = entrylist[fileind]
-                        if fname not in fnames:
-                            fnames.append(fname)
-                        redfile = nc.Dataset(fname, 'r')
-                        this_n = redfile.dimensions['records'].size
-
-                        if fileind == len(entrylist) - 1:
-                            tmp_avg = data_by_inds(redfile, 0, end-start)
-                            for key in avg:
-                                avg[key] = np.append(avg[key], tmp_avg[key], axis=0)
-                        elif fileind == 2:
-                            avg = data_by_inds(redfile, start-n, -1)
-                            n += this_n
-                        else:
-                            tmp_avg = data_by_inds(redfile, 0, -1)
-                            n += this_n
-                            for key in avg:
+                avg = None
+                for fname, start, end in plan.pieces(prolist[i]):
+                    if fname not in opened:
+                        opened[fname] = nc.Dataset(fname, 'r')
+                    redfile = opened[fname]
+
+                    tmp_avg = data_by_inds(redfile, start, end)
+                    if avg is None:
+                        avg = tmp_avg
+                    else:
+                        for key in avg:
+                            if 'records' in redfile.variables[key].dimensions:
                                 avg[key] = np.append(avg[key], tmp_avg[key], axis=0)
 
                 if version is not None and version != redfile.version:
@@ -826,27 +1173,116 @@ def redfiles2prodir(redfiles, prodir, timescale, std=True):
                 except:
                     save_file.source = "UNKNOWN"
             save_file.close()
+            for redfile in opened.values():
+                redfile.close()
+
+    if manifest:
+        # Files of months to make again that were not made are left out,
+        # so they are made again by the next call
+        for fname in redfiles:
+            fmonths = record.months(fname, span, timescale.tz)
+            if not set(fmonths) & todo <= months:
+                continue
+            record.record(fname, params, prodir, months=fmonths, span=span,
+                          tz=None if timescale.tz is None else str(timescale.tz))
+        record.save()
 
 
 def rawfiles2redfiles(rawfiles, reddir, corr_target=3.5, corr_trp_temp=273.15,
                       corr_method="median", red_f=np.array([-1, 1]), red_f0=0,
                       red_steps=10, start_ind=0, end_ind=-1,
-                      cold_offset=0., hot_offset=0.):
+                      cold_offset=0., hot_offset=0., resume=False, workers=4,
+                      manifest=False):
+    """ Reduces raw files to reduced files in reddir
+
+        The files are reduced by clb_nc.save_full_red in a pool of
+        workers processes.  Every reduced file is written to a hidden
+        ".red.<name>.part" file in reddir and renamed to "red.<name>"
+        when complete, so partial reduced files never appear.  With
+        resume, a ".part" file left by an earlier run is completed,
+        otherwise it is written anew.
+
+        With manifest, the raw files are recorded in the manifest
+        ".manifest.json" of reddir with the reduction parameters, and
+        raw files already reduced with the same parameters and not
+        changed since are skipped.
+
+        Output:
+            list of a dict for each raw file, with keys rawfile,
+            redfile, status ("done", "failed" or "skipped"), records,
+            time (wall time in seconds) and error (the exception text
+            or None)
+    """
     trp = trp_corr(trp_target=corr_target, trp_temp=corr_trp_temp,  method=corr_method)
     red = {"freq0": red_f0, 'freq': red_f, 'steps': red_steps, "start_ind": start_ind,
            "end_ind": end_ind, "cold": cold_offset, "hot": hot_offset}
 
-    for rawfile in rawfiles:
-        try:
-            print("Doing", rawfile)
-            clb = clb_nc(rawfile)
-
-            fname = os.path.join(reddir,
-                                 'red.' + os.path.split(rawfile)[-1])
+    jobs = rawfiles
+    if manifest:
+        record = pipeline_manifest(os.path.join(reddir, '.manifest.json'))
+        params = {'corr_target': float(corr_target), 'corr_trp_temp': float(corr_trp_temp),
+                  'corr_method': corr_method, 'red_f0': float(red_f0),
+                  'red_f': hashlib.sha1(np.asarray(red_f, dtype=float).tobytes()).hexdigest(),
+                  'red_steps': int(red_steps), 'start_ind': int(start_ind),
+                  'end_ind': int(end_ind), 'cold_offset': float(cold_offset),
+                  'hot_offset': float(hot_offset)}
+        jobs = [rawfile for rawfile in rawfiles if record.changed(rawfile, params)]
+
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {rawfile: pool.submit(rawfile2redfile, rawfile, reddir, trp, red, resume)
+                   for rawfile in jobs}
+        out = []
+        for rawfile in rawfiles:
+            if rawfile in futures:
+                out.append(futures[rawfile].result())
+            else:
+                entry = record.entries[os.path.abspath(rawfile)]
+                out.append({'rawfile': rawfile, 'redfile': entry['output'],
+                            'status': 'skipped', 'records': entry['records'],
+                            'time': 0.0, 'error': None})
+
+    if manifest:
+        for x in out:
+            if x['status'] == 'done':
+                record.record(x['rawfile'], params, x['redfile'], records=x['records'])
+        record.save()
+
+    for x in out:
+        if x['status'] == 'failed':
+            print("Failed to reduce {}: {}".format(x['rawfile'], x['error']))
+    print("reduced {} files, {} records in {:.1f} s, skipped {}, {} failed".format(
+          sum(x['status'] == 'done' for x in out),
+          sum(x['records'] for x in out if x['status'] == 'done'), time.time() - t0,
+          sum(x['status'] == 'skipped' for x in out),
+          sum(x['status'] == 'failed' for x in out)))
+    return out
+
+
+def rawfile2redfile(rawfile, reddir, trp, red, resume=False):
+    """ Reduces a raw file to reddir, see rawfiles2redfiles
+
+        Returns the dict of the result of the file, errors included
+    """
+    name = os.path.split(rawfile)[-1]
+    fname = os.path.join(reddir, 'red.' + name)
+    tmpname = os.path.join(reddir, '.red.' + name + '.part')
+    out = {'rawfile': rawfile, 'redfile': fname, 'status': 'failed',
+           'records': 0, 'time': 0.0, 'error': None}
 
-            clb.save_full_red(fname, trp, red)
-        except:
-            pass
+    t0 = time.time()
+    try:
+        print("Doing", rawfile)
+        clb = clb_nc(rawfile)
+        out['records'] = clb.save_full_red(tmpname, trp, red, resume=resume)
+        os.replace(tmpname, fname)
+        out['status'] = 'done'
+    except Exception as e:
+        out['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        if not resume and os.path.exists(tmpname):
+            os.remove(tmpname)
+    out['time'] = time.time() - t0
+    return out
 
 
 def profile2invfile(profile, invfile, p_grid, f_adjust, covmat_sx, atmdir, linefile, inv_func, truncate=True, custom_sx=False):
@@ -63,7 +63,7 @@ class oem_retrieval():
         self.noise  = np.array([]) # This array will hold the noise for the radiometer
         self.freq   = np.array([]) # This array will hold the frequencies of "signal" and "noise"
 
-    def load_data(self,data_type='radiometer',use_data=0,filename='',signal=[],noise=[],freq=[]):
+    def load_data(self,data_type='radiometer',use_data=0,filename='',signal=[],noise=[],freq=[],time_range=None):
         """
         AUTHOR:
           Hayden Smotherman
@@ -84,6 +84,9 @@ class oem_retrieval():
                    ONLY USED WITH data_type='numpy'
           freq   - An array of the central frequency of each datapoint in "signal" and "noise"
                    ONLY USED WITH data_type='numpy'
+          time_range - (start, end) times to load from the file, read through the
+                       index of the file. The full file is loaded if None
+                   ONLY USED WITH data_type='radiometer'
         OUTPUTS:
         """
 
@@ -110,7 +113,10 @@ class oem_retrieval():
                 raise ImportError('Could not understand the data format based on the file name.')
 
             Calibrated = calibration(format=data_format)
-            Calibrated.load(filename)
+            if time_range is None:
+                Calibrated.load(filename)
+            else:
+                Calibrated.load_time(filename, time_range[0], time_range[1])
             Calibrated.calibrate()
 
             # Pre-allocate signal and noise arrays
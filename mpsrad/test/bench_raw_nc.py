@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of writing raw_nc files
+
+Writes the same records as measurements.run does for one spectrometer
+and prints the records/s of each way of saving, with and without
+buffering, the time the measurements wait for saves with and without a
+writer thread, and the write rate, read rate and size on disk of each
+storage profile.
+"""
+import os
+import time
+import tempfile
+import numpy as np
+import netCDF4 as nc
+
+from mpsrad.files import raw_nc, raw_nc_buffer, raw_nc_thread, storage_profiles
+
+
+def records(n, channels=8192, spectras=1):
+	"""Records like the ones saved by measurements.run"""
+	hk = ['hemt_temp', 'cold_load', 'hot_load', 'cts1_temp1', 'cts1_temp2',
+		'air_temp', 'cts2_temp1', 'cts2_temp2', 'air_temp2']
+	x = np.linspace(0, 1, channels*spectras)
+	spectrum = np.float32(1e6 + 2e5*np.sin(3*x) + 1e4/(1 + ((x-0.5)/0.01)**2))
+	for i in range(n):
+		data = {key: np.array([np.float32(i)]) for key in hk}
+		data['time'] = np.array([time.time()])
+		data['record'] = spectrum + np.float32(
+			np.random.normal(0, 100, channels*spectras))
+		yield data
+
+
+def bench_save(n=400, channels=8192, spectras=1, cycles=0, **kwargs):
+	"""Returns records/s of raw_nc.save with kwargs for raw_nc
+
+	With cycles, the records are saved through a raw_nc_buffer of as
+	many chopper cycles
+	"""
+	with tempfile.TemporaryDirectory() as d:
+		f = raw_nc(os.path.join(d, 'bench.nc'), n, **kwargs)
+		if cycles:
+			f = raw_nc_buffer(f, cycles)
+		t0 = time.time()
+		for data in records(n, channels, spectras):
+			f.save(data, 'bench', spectras)
+		f.close()
+		return n / (time.time() - t0)
+
+
+def bench_thread(n=400, channels=8192, spectras=1, integration=0.005,
+		queue_records=64, **kwargs):
+	"""Returns mean and max seconds the measurements wait for a save
+
+	Every record takes integration seconds to measure, and is saved
+	directly or, with queue_records, through a raw_nc_thread
+	"""
+	with tempfile.TemporaryDirectory() as d:
+		f = raw_nc(os.path.join(d, 'bench.nc'), n, **kwargs)
+		if queue_records:
+			f = raw_nc_thread(f, queue_records)
+		wait = []
+		for data in records(n, channels, spectras):
+			time.sleep(integration)
+			t0 = time.time()
+			f.save(data, 'bench', spectras)
+			wait.append(time.time() - t0)
+		f.close()
+		return np.mean(wait), np.max(wait)
+
+
+def bench_storage(storage, n=400, channels=8192, spectras=1, block=64):
+	"""Returns write records/s, read records/s and bytes of a storage profile
+
+	Writing is as measurements.run with keep_open, and reading is
+	sequential in blocks of records
+	"""
+	with tempfile.TemporaryDirectory() as d:
+		fname = os.path.join(d, 'bench.nc')
+		f = raw_nc(fname, n, keep_open=True, storage=storage)
+		t0 = time.time()
+		for data in records(n, channels, spectras):
+			f.save(data, 'bench', spectras)
+		f.close()
+		write = n / (time.time() - t0)
+
+		t0 = time.time()
+		with nc.Dataset(fname, 'r') as x:
+			for i in range(0, n, block):
+				x.variables['record'][i:i+block]
+		read = n / (time.time() - t0)
+
+		return write, read, os.path.getsize(fname)
+
+
+if __name__ == '__main__':
+	n = 400
+	print('open/close per record: {:.1f} records/s'.format(bench_save(n)))
+	for sync_records in [1, 12, 100]:
+		print('keep_open, sync every {} records: {:.1f} records/s'.format(
+			sync_records, bench_save(n, keep_open=True,
+				sync_records=sync_records)))
+	for cycles in [4, 16]:
+		print('buffer of {} cycles: {:.1f} records/s'.format(
+			cycles, bench_save(n, cycles=cycles)))
+		print('keep_open, buffer of {} cycles: {:.1f} records/s'.format(
+			cycles, bench_save(n, cycles=cycles, keep_open=True)))
+
+	for queue_records in [0, 64]:
+		mean, worst = bench_thread(n, queue_records=queue_records)
+		print('queue of {} records: waits {:.4f} s on average, at most {:.4f} s'.format(
+			queue_records, mean, worst))
+
+	for storage in storage_profiles:
+		write, read, size = bench_storage(storage, n)
+		print('{}: write {:.1f} records/s, read {:.1f} records/s, {:.1f} MB'.format(
+			storage, write, read, size / 1e6))
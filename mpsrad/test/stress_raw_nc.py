@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stress test of one writer and several readers of a live raw_nc file
+
+The writer saves records like measurements.run while the readers, in
+other processes, read the committed records over and over.  Every record
+i is filled with i, so the readers check that they never see a record
+that is not fully written, and that the committed count never decreases.
+The writer must not be slowed down by the readers, and without keep_open
+every record must be committed when "save" returns.
+
+Also checks a reader in the process of a writer keeping the file open, a
+reader in a session over the whole writing, reading a file without a lock
+file, as in an archive that cannot be written, and several files saved
+and read by threads of one process at once, as netCDF4 is not thread
+safe.
+"""
+import os
+import time
+import tempfile
+import threading
+import multiprocessing
+
+# The writer is in this process, see raw_nc.  Must be set before HDF5 is
+# loaded
+os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+
+import numpy as np
+
+from mpsrad.files import raw_nc, raw_nc_thread
+
+
+def record(i, channels):
+	return {'time': np.array([time.time()]),
+		'cold_load': np.array([np.float32(i)]),
+		'record': np.full(channels, i, dtype=np.float32)}
+
+
+def writer(fname, n, channels, **kwargs):
+	"""Saves n records of channels to fname, returns records/s"""
+	f = raw_nc(fname, n, **kwargs)
+	t0 = time.time()
+	for i in range(n):
+		f.save(record(i, channels), 'stress')
+	f.close()
+	return n / (time.time() - t0)
+
+
+def reader(fname, n, queue):
+	"""Reads the committed records of fname until all n are committed
+
+	Every tenth read is of all the committed records, the others of the
+	last 8 as by a quick-look
+	"""
+	f = raw_nc(fname)
+	while not os.path.exists(fname):
+		time.sleep(0.01)
+
+	reads = 0
+	last = 0
+	latency = []
+	errors = []
+	while last < n:
+		t0 = time.time()
+		try:
+			if (reads + 1) % 10:
+				with f.session():
+					m = f.committed()
+					m0 = max(0, m - 8)
+					record = f.get_variable('record', slice(m0, m))
+			else:
+				record = f.get_committed('record')
+				m0, m = 0, len(record)
+		except RuntimeError as e:
+			# The file is not yet created by the writer
+			errors.append(str(e))
+			time.sleep(0.01)
+			continue
+		latency.append(time.time() - t0)
+		reads += 1
+
+		if m < last:
+			errors.append('committed records went from {} to {}'.format(last, m))
+		expect = np.arange(m0, m, dtype=np.float32)[:, None, None]
+		if np.ma.is_masked(record) or not np.all(record == expect):
+			errors.append('bad records among the {} committed'.format(m))
+		last = m
+
+	queue.put((reads, np.mean(latency), np.max(latency),
+		[e for e in errors if not e.startswith('Cannot open')]))
+
+
+def stress(readers=4, n=1000, channels=8192, **kwargs):
+	"""Runs a writer and readers on one file and prints the results
+
+	Fails if the writer is more than twice as slow with the readers as
+	alone on its share of the processors
+	"""
+	with tempfile.TemporaryDirectory() as d:
+		alone = writer(os.path.join(d, 'alone.nc'), n, channels, **kwargs)
+
+		fname = os.path.join(d, 'stress.nc')
+		queue = multiprocessing.Queue()
+		procs = [multiprocessing.Process(target=reader, args=(fname, n, queue))
+			for i in range(readers)]
+		for p in procs:
+			p.start()
+		rate = writer(fname, n, channels, **kwargs)
+		results = [queue.get() for p in procs]
+		for p in procs:
+			p.join()
+
+		print('{}: writer {:.1f} records/s, {:.1f} records/s alone'.format(
+			kwargs, rate, alone))
+		share = min(1, (os.cpu_count() or 1) / (readers + 1))
+		ok = rate > alone * share / 2
+		for reads, mean, worst, errors in results:
+			print('\treader: {} reads, mean {:.3f} s, max {:.3f} s, {} errors'.format(
+				reads, mean, worst, len(errors)))
+			for e in errors[:5]:
+				print('\t\t' + e)
+			ok = ok and not errors
+		return ok
+
+
+def durable(readers=4, n=300, channels=8192):
+	"""Every record is committed when "save" returns without keep_open,
+	while readers read the file
+	"""
+	with tempfile.TemporaryDirectory() as d:
+		fname = os.path.join(d, 'durable.nc')
+		queue = multiprocessing.Queue()
+		procs = [multiprocessing.Process(target=reader, args=(fname, n, queue))
+			for i in range(readers)]
+		for p in procs:
+			p.start()
+		f = raw_nc(fname, n)
+		r = raw_nc(fname)
+		lost = 0
+		for i in range(n):
+			f.save(record(i, channels), 'stress')
+			lost = max(lost, i + 1 - r.committed())
+		f.close()
+		results = [queue.get() for p in procs]
+		for p in procs:
+			p.join()
+	errors = sum(len(x[3]) for x in results)
+	print('records saved but not committed at most {}, {} reader errors'.format(
+		lost, errors))
+	return not lost and not errors
+
+
+def timeout(func, seconds=10):
+	"""Returns func() run in a thread, or raises if it does not return"""
+	out = []
+
+	def run():
+		try:
+			out.append((func(), None))
+		except Exception as e:
+			out.append((None, e))
+	t = threading.Thread(target=run, daemon=True)
+	t.start()
+	t.join(seconds)
+	if not out:
+		raise RuntimeError('timed out')
+	if out[0][1] is not None:
+		raise out[0][1]
+	return out[0][0]
+
+
+def same_process(n=20, channels=64):
+	"""A reader in the process of a writer that keeps the file open"""
+	with tempfile.TemporaryDirectory() as d:
+		fname = os.path.join(d, 'same.nc')
+		f = raw_nc(fname, n, keep_open=True, sync_records=4)
+		for i in range(n):
+			f.save(record(i, channels), 'stress')
+			m = timeout(lambda: len(raw_nc(fname).get_committed('record'))
+				if os.path.exists(fname) else 0)
+			assert m == i + 1 - (i + 1) % 4, 'committed {} of {}'.format(m, i+1)
+		f.close()
+	print('reader in the writer process: OK')
+
+
+def session(n=200, channels=64, **kwargs):
+	"""The writer commits records while a reader is in a session"""
+	with tempfile.TemporaryDirectory() as d:
+		fname = os.path.join(d, 'session.nc')
+		f = raw_nc(fname, n, **kwargs)
+		f.save(record(0, channels), 'stress')
+		f.sync()
+		r = raw_nc(fname)
+
+		def run():
+			with r.session():
+				for i in range(1, n):
+					f.save(record(i, channels), 'stress')
+					assert np.all(r.get_variable('record', 0) == 0), \
+						'bad record in session'
+				return raw_nc(fname).committed()
+		m = timeout(run)
+		f.close()
+	print('{}: {} of {} records committed in a session'.format(kwargs, m, n))
+	return m >= n - f.sync_records
+
+def no_lock(n=20, channels=64):
+	"""Reads a file without lock file"""
+	with tempfile.TemporaryDirectory() as d:
+		fname = os.path.join(d, 'archive.nc')
+		writer(fname, n, channels)
+		os.remove(fname + '.lock')
+		r = raw_nc(fname)
+		assert r.get_pos() == n - 1 and len(r.get_committed('record')) == n
+		with r.session():
+			assert r.get_variable('record', n-1)[0, 0] == n - 1
+	print('file without lock file: OK')
+
+
+def threads(files=3, n=300, channels=1024):
+	"""Saves files in a raw_nc_thread each while threads read them"""
+	with tempfile.TemporaryDirectory() as d:
+		fnames = [os.path.join(d, 'thread{}.nc'.format(k)) for k in range(files)]
+		errors = []
+
+		def read(fname):
+			r = raw_nc(fname)
+			m = 0
+			while m < n:
+				try:
+					with r.session():
+						m = r.committed()
+						x = r.get_variable('record', slice(max(0, m - 8), m))
+				except RuntimeError:
+					# The file is not yet created by the writer
+					time.sleep(0.001)
+					continue
+				if not np.all(x[:, 0, 0] == np.arange(max(0, m - 8), m)):
+					errors.append('bad records in ' + fname)
+					return
+
+		readers = [threading.Thread(target=read, args=(fname, ), daemon=True)
+			for fname in fnames]
+		for t in readers:
+			t.start()
+		writers = [raw_nc_thread(raw_nc(fname, n, keep_open=k % 2 == 0,
+			sync_records=4)) for k, fname in enumerate(fnames)]
+		for i in range(n):
+			for f in writers:
+				f.save(record(i, channels), 'stress')
+		for f in writers:
+			f.close()
+		for t in readers:
+			t.join(10)
+			if t.is_alive():
+				errors.append('reader timed out')
+
+		for fname in fnames:
+			x = raw_nc(fname).get_committed('record')
+			if len(x) != n or not np.all(x[:, 0, 0] == np.arange(n)):
+				errors.append('bad records in ' + fname)
+	print('{} files in threads: {}'.format(files, errors[0] if errors else 'OK'))
+	return not errors
+
+
+if __name__ == '__main__':
+	same_process()
+	no_lock()
+	ok = session()
+	ok = session(keep_open=True) and ok
+	ok = threads() and ok
+	ok = durable() and ok
+	ok = stress() and ok
+	ok = stress(keep_open=True) and ok
+	ok = stress(keep_open=True, sync_records=1) and ok
+	print('OK' if ok else 'FAILED')
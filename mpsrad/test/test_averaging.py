@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of averaging.average_single against fixed expectations
+
+The spectra are small integers, so every average is exact in float32.
+"""
+import os
+import tempfile
+import numpy as np
+
+from mpsrad.files import averaging
+
+# Time, 16 housekeeping values and 7 channels
+form = '>i16f7f'
+
+
+def make(spectra):
+	"""Returns averaging of a file of the spectra, with times 100, 101, ..."""
+	spectra = np.asarray(spectra, dtype=np.float32)
+	records = np.zeros(len(spectra), dtype=[('time', '>i4'),
+		('hk', '>f4', (16, )), ('data', '>f4', (spectra.shape[1], ))])
+	records['time'] = 100 + np.arange(len(spectra))
+	records['data'] = spectra
+
+	fd, filename = tempfile.mkstemp(suffix='.raw')
+	os.close(fd)
+	records.tofile(filename)
+
+	a = averaging(form)
+	a.load(filename)
+	a._tmpname = filename
+	return a
+
+
+def spectra(n):
+	"""Spectrum i is i + channel, with channel 0 to 6"""
+	return np.arange(n)[:, np.newaxis] + np.arange(7)[np.newaxis, :]
+
+
+def run(spectra, **kwargs):
+	a = make(spectra)
+	try:
+		a.average_single(**kwargs)
+		return np.array(a._data), a._time
+	finally:
+		del a._records, a._rawarray, a._rawtimearray
+		os.remove(a._tmpname)
+
+
+def test_block():
+	# Blocks of spectra 0-2 and 4-6, spectra 3 and 7 end them and are
+	# not used.  Channel 0 is trimmed, bins of channels 1-2, 3-4, 5-6
+	data, time = run(spectra(9), number_of_spectra=3, number_of_xbin=2)
+	np.testing.assert_array_equal(data, [[2.5, 4.5, 6.5], [6.5, 8.5, 10.5]])
+	assert time == [[100, 103], [104, 107]]
+
+
+def test_block_first_spectrum_once():
+	# The first spectrum of a block used to be added twice
+	x = np.zeros((5, 7))
+	x[0] = 8
+	data, time = run(x, number_of_spectra=4, number_of_xbin=1)
+	np.testing.assert_array_equal(data, [[2]*7])
+	assert time == [[100, 104]]
+
+
+def test_running():
+	# Window i averages spectra i to i+1 and ends at spectrum i+2
+	data, time = run(spectra(5), number_of_spectra=2, number_of_xbin=2,
+		running_average=True)
+	np.testing.assert_array_equal(data,
+		[[2, 4, 6], [3, 5, 7], [4, 6, 8]])
+	assert time == [[100, 102], [101, 103], [102, 104]]
+
+
+def test_running_blocks():
+	# More windows than a block of the sums, against np.mean per window
+	x = np.random.default_rng(1).integers(0, 1000, (300, 7))
+	data, time = run(x, number_of_spectra=70, number_of_xbin=1,
+		running_average=True)
+	expect = [x[i:i+70].mean(axis=0) for i in range(300-70)]
+	np.testing.assert_allclose(data, expect, rtol=1e-6)
+	assert time[-1] == [100+229, 100+299]
+
+
+def test_channel_trimming():
+	# 7 channels in bins of 3: channel 0 is trimmed from the front
+	data, _ = run(spectra(4), number_of_spectra=2, number_of_xbin=3)
+	np.testing.assert_array_equal(data, [[2.5, 5.5]])
+
+	# in bins of 4: channels 0-1 from the front and 6 from the back
+	data, _ = run(spectra(4), number_of_spectra=2, number_of_xbin=4)
+	np.testing.assert_array_equal(data, [[4]])
+
+	# in bins of 5: channel 0 from the front and 6 from the back
+	data, _ = run(spectra(4), number_of_spectra=2, number_of_xbin=5)
+	np.testing.assert_array_equal(data, [[3.5]])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of calib.bin_plan and calib.bindata against the old binning loop
+"""
+import numpy as np
+
+from mpsrad.retrieval.calib import bin_plan, bindata
+
+
+def old_bindata(x, f, f0, steps=6):
+	"""The binning loop of bindata before bin_plan"""
+	n = len(f)
+	if f0 in f:
+		f0bin = np.where(f == f0)[0][0]
+	else:
+		less = f < f0
+		more = f > f0
+		if any(less) and any(more):
+			f0bin = np.where(more)[0][0]
+		elif any(less):
+			f0bin = n
+		else:
+			f0bin = 0
+
+	center = [True]
+	fbin = [f0bin+5*steps]
+	dn = 2
+	while fbin[-1] < n:
+		i = 0
+		while i < steps and fbin[-1] < n:
+			i += 1
+			fbin.append(fbin[-1] + dn)
+			center.append(False)
+		dn *= 2
+	fbin[-1] = n
+
+	center.append(True)
+	fbin.append(f0bin-5*steps)
+	dn = -2
+	while fbin[-1] > 0:
+		i = 0
+		while i < steps and fbin[-1] > 0:
+			i += 1
+			fbin.append(fbin[-1] + dn)
+			center.append(False)
+		dn *= 2
+	fbin[-1] = 0
+
+	INDS = np.argsort(fbin)
+	fbin = np.array(fbin, dtype=int)[INDS]
+	center = np.array(center, dtype=bool)[INDS]
+
+	xred = []
+	fred = []
+	for i in range(1, len(fbin)):
+		if (center[i] == center[i-1]) and center[i]:
+			for j in range(fbin[i-1], fbin[i]):
+				fred.append(f[j])
+				xred.append(x[j])
+		else:
+			fred.append(f[fbin[i-1]:fbin[i]].mean())
+			xred.append(x[fbin[i-1]:fbin[i]].mean())
+	fred = np.array(fred)
+	xred = np.array(xred)
+	INDS = np.argsort(fred)
+	return xred[INDS], fred[INDS]
+
+
+# Grid of 1000 channels, line centers on, between, below and above it
+f = np.linspace(-50, 50, 1000)
+centers = [f[400], 0.025, -60., 60.]
+
+
+def test_bindata():
+	x = np.random.default_rng(0).normal(200, 10, len(f)).astype(np.float32)
+	for f0 in centers:
+		for steps in (2, 6):
+			xred, fred = old_bindata(x, f, f0, steps)
+			xbin, fbin = bindata(x, f, f0, steps)
+			np.testing.assert_array_equal(fbin, fred)
+			np.testing.assert_array_equal(xbin, xred)
+			np.testing.assert_array_equal(bindata(None, f, f0, steps,
+				do_x=False), fred)
+
+
+def test_bin_plan_many():
+	# Every spectrum of a block binned at once as it was one by one
+	x = np.random.default_rng(1).normal(200, 10, (3, 2, len(f)))
+	x = x.astype(np.float32)
+	for f0 in centers:
+		plan = bin_plan(f, f0, 4)
+		out = plan.apply(x)
+		for i in np.ndindex(x.shape[:-1]):
+			xred, fred = old_bindata(x[i], f, f0, 4)
+			np.testing.assert_array_equal(out[i], xred)
+		np.testing.assert_array_equal(plan.f, fred)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of files.calibration against the old calibration loop
+"""
+import numpy as np
+
+from mpsrad.files import calibration
+
+# Time, 4 housekeeping values, 12 channels, 3 noise values and 2 more
+form = '>i4f12f3f2f'
+
+
+def old_calibrate(self, raw, rawtime, sweep_count=None, with_hkp=False):
+	"""The calibration loop of calibration.calibrate before calibrate_array
+
+	Returns the lists of data, time, noise and signal
+	"""
+	raw = list(raw)
+	while len(raw) % 2:
+		del raw[-1]
+
+	sweep = bool(sweep_count)
+	out_data = []
+	out_time = []
+	out_noise = []
+	out_signal = []
+
+	i = 0  # raw-counter
+	count = 1  # calibrated counter
+	d = self._format[self._data_field]
+	n = self._format[self._noise_field]
+	s = self._format[:self._data_field].sum()
+	e = s + d
+	while i < len(raw):
+		# Set the current hot or cold load measurement power
+		if self._hot:
+			h = raw[i][s:e]
+			if not with_hkp:
+				th = self._th
+			elif raw[i][1] > 0:
+				th = raw[i][0]
+			else:
+				th = self._th
+		else:
+			c = raw[i][s:e]
+			if not with_hkp:
+				tc = self._tc
+			elif raw[i][0] > 0:
+				tc = raw[i][0]
+			else:
+				tc = self._tc
+
+		# Set the current measurement power
+		i += 1
+		self._hot = not self._hot
+		data = np.array(raw[i][:s])
+		data_end = raw[i][(e+n):]
+		m = raw[i][s:e]
+		i += 1
+
+		# Read ahead to use the first data record
+		if count == 1:
+			if self._hot:
+				h = raw[i][s:e]
+				if not with_hkp:
+					th = self._th
+				elif raw[i][1] > 0:
+					th = raw[i][0]
+				else:
+					th = self._th
+			else:
+				c = raw[i][s:e]
+				if not with_hkp:
+					tc = self._tc
+				elif raw[i][0] > 0:
+					tc = raw[i][0]
+				else:
+					tc = self._tc
+
+		signal = tc + (m-c)*(th-tc)/(h-c)
+		noise_array = ((th*c-tc*h)/(h-c))
+		noise = noise_array.reshape(n, d//n).mean(axis=1)
+		data[0] = tc
+		data[1] = th
+
+		# Store
+		if sweep:
+			if not count % sweep_count:
+				count = 1
+				continue
+		out_noise.append(noise_array)
+		out_signal.append(signal)
+		out_data.append(np.append(np.append(np.append(data, signal),
+			noise), data_end))
+		out_time.append(rawtime[i-1])
+
+		count += 1
+	return out_data, out_time, out_noise, out_signal
+
+
+def records(n, seed=0):
+	"""n records of loads and measurements, with times 100, 101, ...
+
+	Half of the loads have flagged housekeeping temperatures
+	"""
+	rng = np.random.default_rng(seed)
+	raw = np.empty((n, 21), dtype=np.float32)
+	raw[:, :4] = rng.uniform(15, 300, (n, 4))
+	raw[:, 1] = rng.integers(0, 2, n)
+	raw[::3, 0] = 0
+	raw[0::4, 4:16] = rng.uniform(90, 110, (len(raw[0::4]), 12))
+	raw[2::4, 4:16] = rng.uniform(290, 310, (len(raw[2::4]), 12))
+	raw[1::2, 4:16] = rng.uniform(150, 250, (len(raw[1::2]), 12))
+	raw[:, 16:] = rng.uniform(0, 1, (n, 5))
+	return raw, 100 + np.arange(n)
+
+
+def compare(n, hot, sweep_count=None, with_hkp=False):
+	raw, rawtime = records(n)
+
+	old = calibration(form)
+	old._hot = hot
+	data, time, noise, signal = old_calibrate(old, list(raw), list(rawtime),
+		sweep_count, with_hkp)
+
+	new = calibration(form)
+	new._hot = hot
+	new._raw = list(raw)
+	new._rawtime = list(rawtime)
+	new.calibrate(sweep_count, with_hkp)
+
+	np.testing.assert_array_equal(new._data, data)
+	np.testing.assert_array_equal(new._time, time)
+	np.testing.assert_array_equal(new._noise, noise)
+	np.testing.assert_array_equal(new._signal, signal)
+	assert new._hot == old._hot
+
+
+def test_calibrate():
+	for hot in (False, True):
+		for with_hkp in (False, True):
+			compare(40, hot, with_hkp=with_hkp)
+			# A trailing load is not used
+			compare(41, hot, with_hkp=with_hkp)
+
+
+def test_calibrate_sweeps():
+	# The last cycle must not start a sweep, as the old loop read past
+	# the records to find its other load
+	for hot in (False, True):
+		for with_hkp in (False, True):
+			compare(46, hot, 3, with_hkp)
+			compare(47, hot, 3, with_hkp)
+			compare(44, hot, 4, with_hkp)
+
+
+def test_calibration_indices():
+	# Cycles of load, measurement: C A H A C A H A ... starting cold
+	c = calibration(form)
+	cold, hot, meas = c._calibration_indices(10)
+	np.testing.assert_array_equal(meas, [1, 3, 5, 7, 9])
+	np.testing.assert_array_equal(cold, [0, 0, 4, 4, 8])
+	np.testing.assert_array_equal(hot, [2, 2, 2, 6, 6])
+	assert c._hot
+
+	# Sweeps of 3 cycles: the last of every sweep is not used, and the
+	# first of every sweep looks ahead for its other load, but the last
+	# record is not read past
+	c = calibration(form)
+	cold, hot, meas = c._calibration_indices(14, 3)
+	np.testing.assert_array_equal(meas, [1, 3, 7, 9, 13])
+	np.testing.assert_array_equal(cold, [0, 0, 8, 8, 12])
+	np.testing.assert_array_equal(hot, [2, 2, 6, 6, 10])
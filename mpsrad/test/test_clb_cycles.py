@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of calib.clb_nc.cycles against the calibration of one cycle at a time
+"""
+import numpy as np
+
+from mpsrad.files import raw_nc
+from mpsrad.retrieval.calib import clb_nc, calibrate
+
+
+def rawfile(fname, n, spectras=2, channels=16):
+	"""Raw file of n records of C A H A ... cycles with load offsets"""
+	rng = np.random.default_rng(0)
+	f = raw_nc(fname, n)
+	for i in range(n):
+		load = [100., 200., 300., 200.][i % 4]
+		f.save({'time': np.array([1e9 + i]),
+			'cold_load': rng.uniform(15, 25, 2).astype(np.float32),
+			'hot_load': rng.uniform(290, 300, 2).astype(np.float32),
+			'record': rng.normal(load, 5, spectras*channels).astype(np.float32)},
+			recordslen=spectras)
+	f.close()
+	f.append_attribute('cold_load_offset', 1.5)
+	f.append_attribute('hot_load_offset', -0.5)
+
+
+def test_cycles(tmp_path):
+	fname = str(tmp_path / 'raw.nc')
+	n = 41
+	rawfile(fname, n)
+	clb = clb_nc(fname)
+
+	# Blocks starting on either load, and the last measurement
+	for k0, k1 in [(0, 20), (1, 4), (5, 6), (17, 20)]:
+		x = clb.cycles(k0, k1)
+		assert x['cal'].shape == (k1-k0, 2, 16)
+		for k in range(k0, k1):
+			ind = 2*k + 1
+			cal = calibrate(clb, clb.pc(ind), clb.ph(ind), clb.pm(ind),
+				clb.tc(ind), clb.th(ind))
+			np.testing.assert_allclose(x['cal'][k-k0], cal, rtol=1e-6)
+			np.testing.assert_array_equal(x['pm'][k-k0], clb.pm(ind))
+			np.testing.assert_allclose(x['tc'][k-k0, 0, 0], clb.tc(ind),
+				rtol=1e-6)
+			np.testing.assert_allclose(x['th'][k-k0, 0, 0], clb.th(ind),
+				rtol=1e-6)
+			np.testing.assert_array_equal(x['time'][k-k0],
+				clb.measurement_variable('time', ind))
+
+	# Channels and load temperature changes
+	x = clb.cycles(2, 9, channels=slice(3, 11), cold=2., hot=-1.)
+	for k in range(2, 9):
+		ind = 2*k + 1
+		cal = calibrate(clb, clb.pc(ind), clb.ph(ind), clb.pm(ind),
+			clb.tc(ind) + 2., clb.th(ind) - 1.)
+		np.testing.assert_allclose(x['cal'][k-2], cal[:, 3:11], rtol=1e-6)